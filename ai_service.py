@@ -1,101 +1,750 @@
 import os
+import re
 import json
+import asyncio
+import copy
+import time
+import random
+import hashlib
+import stat
+import string
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass
 import google.generativeai as genai
-from dotenv import load_dotenv
+from google.generativeai import caching
+from google.api_core import exceptions as google_exceptions
+from dotenv import dotenv_values
 from pathlib import Path
-from typing import Optional, Dict, Any
-from datetime import datetime
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Iterator
+from datetime import datetime, timedelta, timezone
 from domain_configurations import (
     get_domain_config, get_content_block_templates,
     format_existing_books_context, DIFFICULTY_ADAPTATIONS,
-    LEARNING_STYLE_ADAPTATIONS
+    LEARNING_STYLE_ADAPTATIONS, DOMAIN_KEYWORDS
 )
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps_canonical(obj) -> bytes:
+        """Serialize with sorted keys to canonical bytes, e.g. for hashing into cache keys."""
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+except ImportError:  # orjson is optional; fall back to the stdlib parser
+    _json_loads = json.loads
+
+    def _json_dumps_canonical(obj) -> bytes:
+        """Serialize with sorted keys to canonical bytes, e.g. for hashing into cache keys."""
+        return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+try:
+    import json_repair
+except ImportError:  # json_repair is optional; malformed JSON is then reported as an error
+    json_repair = None
+
 # --- Setup and Configuration ---
+logger = logging.getLogger(__name__)
 PROMPTS_DIR = Path(__file__).resolve().parent / 'prompts'
 env_path = Path(__file__).resolve().parent / '.env'
-load_dotenv(dotenv_path=env_path)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-if not GEMINI_API_KEY or GEMINI_API_KEY == "YOUR_API_KEY_HERE":
-    print("INFO: GEMINI_API_KEY is not configured. AI services will be disabled.")
-    genai.configure(api_key="placeholder")
-    pro_model = None
-    flash_model = None
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
-    PRO_MODEL_NAME = os.getenv("GEMINI_PRO_MODEL", "gemini-1.5-pro-latest")
-    FLASH_MODEL_NAME = os.getenv("GEMINI_FLASH_MODEL", "gemini-1.5-flash-latest")
 
+
+@dataclass(frozen=True)
+class _Settings:
+    gemini_api_key: Optional[str]
+    pro_model_name: str
+    flash_model_name: str
+    gemini_rpm_limit: Optional[int]
+
+
+@lru_cache(maxsize=1)
+def _get_settings() -> _Settings:
+    """Read the .env file once into an immutable snapshot; process environment variables take precedence."""
+    file_values = dotenv_values(env_path)
+
+    def _value(key, default=None):
+        return os.environ.get(key) or file_values.get(key) or default
+
+    rpm_limit = _value("GEMINI_RPM_LIMIT", "").strip()
+    return _Settings(
+        gemini_api_key=_value("GEMINI_API_KEY"),
+        pro_model_name=_value("GEMINI_PRO_MODEL", "gemini-1.5-pro-latest"),
+        flash_model_name=_value("GEMINI_FLASH_MODEL", "gemini-1.5-flash-latest"),
+        gemini_rpm_limit=int(rpm_limit) if rpm_limit.isdigit() and int(rpm_limit) > 0 else None,
+    )
+
+
+@lru_cache(maxsize=1)
+def _get_api_key() -> Optional[str]:
+    """Return the Gemini API key, configuring the client on first call, or None if not configured."""
+    api_key = _get_settings().gemini_api_key
+    if not api_key or api_key == "YOUR_API_KEY_HERE":
+        logger.info("GEMINI_API_KEY is not configured. AI services will be disabled.")
+        return None
+    genai.configure(api_key=api_key)
+    return api_key
+
+
+def _get_pro_model_name() -> str:
+    """Pro model name from the settings snapshot."""
+    return _get_settings().pro_model_name
+
+
+def _get_flash_model_name() -> str:
+    """Flash model name from the settings snapshot."""
+    return _get_settings().flash_model_name
+
+
+def _is_versioned_model_name(model_name: str) -> bool:
+    """Context caching only accepts explicitly versioned models (e.g. gemini-1.5-pro-002), not -latest aliases."""
+    return re.search(r"-\d{3}$", model_name) is not None
+
+
+def _build_model(model_name: str):
+    """Construct a GenerativeModel, or return None if the API is not configured or the SDK is too old."""
+    if not _get_api_key():
+        return None
     try:
-        pro_model = genai.GenerativeModel(PRO_MODEL_NAME)
-        flash_model = genai.GenerativeModel(FLASH_MODEL_NAME)
+        return genai.GenerativeModel(model_name)
     except AttributeError as e:
-        print(f"ERROR: {e}")
-        print("This might be due to an outdated google-generativeai package.")
-        pro_model = None
-        flash_model = None
+        logger.error("%s (this might be due to an outdated google-generativeai package)", e)
+        return None
+
+
+@lru_cache(maxsize=1)
+def _get_pro_model():
+    """Lazily constructed pro model singleton."""
+    return _build_model(_get_pro_model_name())
+
+
+@lru_cache(maxsize=1)
+def _get_flash_model():
+    """Lazily constructed flash model singleton."""
+    return _build_model(_get_flash_model_name())
 
 
 # --- Helper Functions ---
 
+# A missing or invalid key is re-checked against freshly read settings at this interval (seconds)
+API_CONFIG_RECHECK_INTERVAL = 30.0
+_API_CONFIG_STATE = {"configured": False, "checked_at": None}
+
+
+def reload_settings():
+    """Forget the cached settings, API key, models and rate limiter so the next call reads them again."""
+    for cached in (_get_settings, _get_api_key, _get_pro_model, _get_flash_model, _get_rate_limiter):
+        cached.cache_clear()
+    _API_CONFIG_STATE.update(configured=False, checked_at=None)
+
+
 def _is_api_configured():
-    """Checks if the API key is properly configured and models are available."""
-    return (GEMINI_API_KEY and
-            GEMINI_API_KEY != "YOUR_API_KEY_HERE" and
-            pro_model is not None and
-            flash_model is not None)
+    """
+    Checks if the API key is properly configured and models are available. A positive answer holds
+    for the process; a negative one is re-checked with reloaded settings every API_CONFIG_RECHECK_INTERVAL.
+    """
+    if _API_CONFIG_STATE["configured"]:
+        return True
+    now = time.monotonic()
+    checked_at = _API_CONFIG_STATE["checked_at"]
+    if checked_at is not None:
+        if now - checked_at < API_CONFIG_RECHECK_INTERVAL:
+            return False
+        reload_settings()
+
+    configured = bool(_get_api_key() and
+                      _get_pro_model() is not None and
+                      _get_flash_model() is not None)
+    _API_CONFIG_STATE.update(configured=configured, checked_at=now)
+    return configured
 
 
+@lru_cache(maxsize=32)
 def _load_prompt_template(prompt_name: str) -> str:
-    """Load a prompt template from the prompts directory."""
+    """Load a prompt template from the prompts directory (cached; cleared when templates are written)."""
     try:
         with open(PROMPTS_DIR / prompt_name, 'r', encoding='utf-8') as f:
             return f.read()
     except FileNotFoundError:
-        print(f"ERROR: Prompt file not found: {prompt_name}")
+        logger.error("Prompt file not found: %s", prompt_name)
         return ""
 
 
+_JSON_FENCE_RE = re.compile(r'^\s*(?:```(?:json)?)?\s*(.*?)\s*(?:```)?\s*$', re.DOTALL)
+
+
 def _clean_json_response(response_text: str) -> str:
-    """Clean and extract JSON from AI response."""
-    cleaned = response_text.strip()
-    if cleaned.startswith("```json"):
-        cleaned = cleaned[7:].strip()
-    if cleaned.endswith("```"):
-        cleaned = cleaned[:-3].strip()
-    return cleaned
+    """Clean and extract JSON from AI response, stripping markdown fences in a single pass."""
+    text = response_text.strip()
+    # Fast path: most responses are already bare JSON and need no regex work
+    if text[:1] in ('{', '[') and not text.endswith('```'):
+        return text
+    return _JSON_FENCE_RE.match(text).group(1)
+
+
+def _parse_json_response(response_text: str):
+    """Parse a JSON response, repairing minor syntax slips (trailing commas, bare keys) when json_repair is installed."""
+    cleaned_json = _clean_json_response(response_text)
+    try:
+        return _json_loads(cleaned_json)
+    except json.JSONDecodeError:
+        if json_repair is None:
+            raise
+        repaired = json_repair.loads(cleaned_json)
+        if not isinstance(repaired, (dict, list)):
+            raise
+        return repaired
+
+
+_HASHABLE_PARAM_TYPES = (str, int, float, bool, type(None))
+
+
+@lru_cache(maxsize=32)
+def _template_fields(template: str) -> frozenset:
+    """Names of the replacement fields a template uses, parsed once per template."""
+    return frozenset(field_name.split('.', 1)[0].split('[', 1)[0]
+                     for _, field_name, _, _ in string.Formatter().parse(template) if field_name)
+
+
+@lru_cache(maxsize=1024)
+def _format_cached(template: str, items: tuple) -> str:
+    """Memoized str.format keyed on the template and its sorted parameter items."""
+    return template.format(**dict(items))
 
 
 def _format_prompt_template(template: str, **kwargs) -> str:
     """Format a prompt template with provided parameters."""
     try:
-        return template.format(**kwargs)
+        # Only parameters the template references are part of the rendered prompt, so only they key the cache
+        fields = _template_fields(template)
+        used = {k: v for k, v in kwargs.items() if k in fields}
+        if all(isinstance(v, _HASHABLE_PARAM_TYPES) for v in used.values()):
+            return _format_cached(template, tuple(sorted(used.items())))
+        return template.format(**used)
     except KeyError as e:
-        print(f"WARNING: Missing template parameter: {e}")
+        logger.warning("Missing template parameter: %s", e)
         return template
 
 
-# =========================================================================
-# --- Subject Analysis and Adaptation ---
-# =========================================================================
+# --- Retry Handling ---
+GEMINI_MAX_ATTEMPTS = 5
+_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,  # 429 rate limit / quota
+    google_exceptions.InternalServerError,  # 500
+    google_exceptions.ServiceUnavailable,  # 503
+    google_exceptions.DeadlineExceeded  # 504
+)
 
-def analyze_subject_domain(subject_name: str, course_description: str = "") -> Dict[str, Any]:
+
+class _RateLimiter:
+    """Thread-safe token bucket allowing `rate` calls per `period` seconds, with bursts up to `rate`."""
+
+    def __init__(self, rate: int, period: float = 60.0):
+        self._rate = rate
+        self._period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call may be made."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate / self._period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self._period / self._rate
+            time.sleep(wait)
+
+
+@lru_cache(maxsize=1)
+def _get_rate_limiter() -> Optional[_RateLimiter]:
+    """Client-side limiter sized from GEMINI_RPM_LIMIT, or None when no limit is configured."""
+    rpm = _get_settings().gemini_rpm_limit
+    return _RateLimiter(rpm) if rpm else None
+
+
+def _call_with_retry(fn, *args, max_attempts: int = GEMINI_MAX_ATTEMPTS, base: float = 0.5,
+                     max_delay: float = 30.0, **kwargs):
+    """Call a Gemini API function, retrying transient 429/5xx errors with exponential backoff and jitter."""
+    limiter = _get_rate_limiter()
+    for attempt in range(1, max_attempts + 1):
+        if limiter is not None:
+            # Self-throttle so concurrent and batched paths stay under quota instead of provoking 429s
+            limiter.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except _RETRYABLE_ERRORS as e:
+            if attempt == max_attempts:
+                raise
+            backoff = min(max_delay, base * (2 ** (attempt - 1)))
+            delay = random.uniform(backoff / 2, backoff)
+            logger.warning("Gemini call failed with %s (attempt %d/%d), retrying in %.2fs",
+                           type(e).__name__, attempt, max_attempts, delay)
+            time.sleep(delay)
+
+
+@lru_cache(maxsize=64)
+def _domain_upper(subject_domain: str) -> str:
+    """Heading form of a domain key used in prompts, e.g. 'computer_science' -> 'COMPUTER SCIENCE'."""
+    return subject_domain.upper().replace('_', ' ')
+
+
+_DEFAULT_DIFFICULTY_ADAPTATION = "Adapt appropriately for level"
+_DEFAULT_LEARNING_STYLE_ADAPTATION = "Balance theory and practice"
+
+# (difficulty_level, learning_style) -> (difficulty_adaptations, learning_style_adaptations)
+_ADAPTATIONS = {
+    (difficulty, style): (difficulty_text, style_text)
+    for difficulty, difficulty_text in DIFFICULTY_ADAPTATIONS.items()
+    for style, style_text in LEARNING_STYLE_ADAPTATIONS.items()
+}
+
+
+def _get_adaptations(difficulty_level: str, learning_style: str) -> tuple:
+    """Adaptation guidance for a difficulty/style pair, with per-field fallbacks for unknown values."""
+    adaptations = _ADAPTATIONS.get((difficulty_level, learning_style))
+    if adaptations is None:
+        adaptations = (DIFFICULTY_ADAPTATIONS.get(difficulty_level, _DEFAULT_DIFFICULTY_ADAPTATION),
+                       LEARNING_STYLE_ADAPTATIONS.get(learning_style, _DEFAULT_LEARNING_STYLE_ADAPTATION))
+    return adaptations
+
+
+# Domain configs are static apart from add_custom_domain_config, which clears this cache
+_cached_get_domain_config = lru_cache(maxsize=64)(get_domain_config)
+
+
+@lru_cache(maxsize=32)
+def _domain_prompt_params(subject_domain: str) -> MappingProxyType:
+    """Read-only slice of the extraction prompt parameters that depends only on the domain."""
+    domain_config = _cached_get_domain_config(subject_domain)
+    return MappingProxyType({
+        'subject_domain': subject_domain,
+        'subject_domain_upper': _domain_upper(subject_domain),
+        'domain_specific_instructions': domain_config.get("extraction_instructions",
+                                                          "Focus on clear explanations with practical examples"),
+        'content_block_guidelines': domain_config.get("extraction_instructions", "")
+    })
+
+
+# --- Subject Analysis Cache ---
+# Keyed by the free-text course description too, so bound it as an LRU
+SUBJECT_ANALYSIS_CACHE_MAX_ENTRIES = 512
+_SUBJECT_ANALYSIS_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_SUBJECT_ANALYSIS_LOCK = threading.Lock()
+
+
+def _subject_analysis_key(subject_name: str, course_description: str) -> str:
+    """Build a stable cache key from the normalized subject name and description."""
+    normalized = f"{subject_name.lower().strip()}|{(course_description or '').lower().strip()}"
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def clear_subject_cache() -> int:
+    """Clear cached subject analyses and return the number of evicted entries."""
+    with _SUBJECT_ANALYSIS_LOCK:
+        evicted = len(_SUBJECT_ANALYSIS_CACHE)
+        _SUBJECT_ANALYSIS_CACHE.clear()
+    return evicted
+
+
+# --- Course Intelligence Cache ---
+# Course research rarely changes, and many students share the same course at the same university
+COURSE_INTELLIGENCE_CACHE_TTL = timedelta(days=7)
+_COURSE_INTELLIGENCE_CACHE: Dict[str, tuple] = {}
+_COURSE_INTELLIGENCE_LOCK = threading.Lock()
+_COURSE_INTELLIGENCE_STATS = {"hits": 0, "misses": 0}
+
+
+def _course_intelligence_key(course_name: str, university: str, course_code: str) -> str:
+    """Build a stable cache key from the normalized course name, university and course code."""
+    normalized = _json_dumps_canonical({
+        "course": (course_name or '').lower().strip(),
+        "uni": (university or '').lower().strip(),
+        "code": ''.join((course_code or '').lower().split())
+    })
+    return hashlib.sha256(normalized).hexdigest()
+
+
+def _get_cached_course_intelligence(cache_key: str) -> Optional[dict]:
+    """Return a copy of a live cached course intelligence entry, recording the hit or miss."""
+    now = datetime.now(timezone.utc)
+    with _COURSE_INTELLIGENCE_LOCK:
+        entry = _COURSE_INTELLIGENCE_CACHE.get(cache_key)
+        if entry and entry[1] > now:
+            _COURSE_INTELLIGENCE_STATS["hits"] += 1
+            return copy.deepcopy(entry[0])
+        _COURSE_INTELLIGENCE_CACHE.pop(cache_key, None)
+        _COURSE_INTELLIGENCE_STATS["misses"] += 1
+    return None
+
+
+def clear_course_intelligence_cache() -> int:
+    """Clear cached course intelligence and return the number of evicted entries."""
+    with _COURSE_INTELLIGENCE_LOCK:
+        evicted = len(_COURSE_INTELLIGENCE_CACHE)
+        _COURSE_INTELLIGENCE_CACHE.clear()
+    return evicted
+
+
+# --- LLM Response Cache ---
+# Exact-match cache of generated text keyed by model and prompt; bounded LRU with a TTL
+LLM_RESPONSE_CACHE_TTL = timedelta(hours=24)
+LLM_RESPONSE_CACHE_MAX_ENTRIES = 1024
+_LLM_RESPONSE_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+_LLM_RESPONSE_LOCK = threading.Lock()
+
+
+def _llm_cache_key(model, prompt: str) -> str:
+    """Hash the model name and prompt into a cache key."""
+    return hashlib.sha256(f"{model.model_name}\0{prompt}".encode('utf-8')).hexdigest()
+
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    """Return cached response text for a key, dropping it if expired."""
+    now = datetime.now(timezone.utc)
+    with _LLM_RESPONSE_LOCK:
+        entry = _LLM_RESPONSE_CACHE.get(key)
+        if entry is None:
+            return None
+        text, expires_at = entry
+        if expires_at <= now:
+            del _LLM_RESPONSE_CACHE[key]
+            return None
+        _LLM_RESPONSE_CACHE.move_to_end(key)
+        return text
+
+
+def _llm_cache_set(key: str, text: str):
+    """Store response text, evicting the least recently used entries beyond the size limit."""
+    with _LLM_RESPONSE_LOCK:
+        _LLM_RESPONSE_CACHE[key] = (text, datetime.now(timezone.utc) + LLM_RESPONSE_CACHE_TTL)
+        _LLM_RESPONSE_CACHE.move_to_end(key)
+        while len(_LLM_RESPONSE_CACHE) > LLM_RESPONSE_CACHE_MAX_ENTRIES:
+            _LLM_RESPONSE_CACHE.popitem(last=False)
+
+
+def _generate_json_cached(model, prompt: str, bypass_cache: bool = False) -> dict:
+    """Generate and parse a JSON response, caching the raw text only once it parses."""
+    key = _llm_cache_key(model, prompt)
+    text = None if bypass_cache else _llm_cache_get(key)
+    if text is None:
+        text = _call_with_retry(model.generate_content, prompt).text
+        result = _parse_json_response(text)
+        _llm_cache_set(key, text)
+        return result
+    return _parse_json_response(text)
+
+
+class StreamError(str):
     """
-    Analyze the subject to determine appropriate learning strategies and content types.
+    Error message yielded as the last chunk of a text stream. Streaming callers can show it like
+    any other text; _join_stream returns it alone instead of appending it to a partial answer.
     """
-    if not _is_api_configured():
-        return {"error": "Cannot analyze subject. Gemini API key is not configured."}
 
+
+def _join_stream(chunks: Iterator[str]) -> str:
+    """Collect a text stream into one string, or just the error message if the stream failed."""
+    parts = []
+    for chunk in chunks:
+        if isinstance(chunk, StreamError):
+            return str(chunk)
+        parts.append(chunk)
+    return "".join(parts)
+
+
+def _stream_text_cached(model, prompt: str, bypass_cache: bool = False) -> Iterator[str]:
+    """Stream a text response, replaying a cached response in one chunk and caching fully consumed streams."""
+    key = _llm_cache_key(model, prompt)
+    if not bypass_cache:
+        cached = _llm_cache_get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    parts = []
+    for chunk in _call_with_retry(model.generate_content, prompt, stream=True):
+        parts.append(chunk.text)
+        yield chunk.text
+    _llm_cache_set(key, "".join(parts))
+
+
+def clear_llm_response_cache() -> int:
+    """Clear cached LLM responses and return the number of evicted entries."""
+    with _LLM_RESPONSE_LOCK:
+        evicted = len(_LLM_RESPONSE_CACHE)
+        _LLM_RESPONSE_CACHE.clear()
+    return evicted
+
+
+# --- In-flight Request Coalescing ---
+_INFLIGHT: Dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def _coalesce(key: str, fn, *args, **kwargs):
+    """
+    Run fn once per key at a time: the first caller does the work and concurrent callers with the
+    same key wait for it and receive a copy of its result (or its exception).
+    """
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = _INFLIGHT[key] = Future()
+
+    if not is_owner:
+        return copy.deepcopy(future.result())
+
+    try:
+        result = fn(*args, **kwargs)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(copy.deepcopy(result))
+        return result
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
+# --- PDF Context Cache ---
+PDF_CONTEXT_CACHE_TTL = timedelta(hours=1)
+# Gemini rejects PDFs below the minimum cacheable size; don't retry the same file every call
+PDF_CONTEXT_CACHE_RETRY_AFTER = timedelta(hours=1)
+_PDF_CONTEXT_CACHES: Dict[str, tuple] = {}  # file hash -> (cache name or None, retry_after or None)
+_PDF_CONTEXT_LOCK = threading.Lock()
+
+
+def _sha256_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file in fixed-size chunks so large PDFs are never loaded whole."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# --- Uploaded File Cache ---
+# Gemini deletes uploaded files after 48 hours; expire our handles a little earlier
+GEMINI_FILE_LIFETIME = timedelta(hours=47)
+# Content hash -> Gemini file name, so restarts can reuse uploads that are still alive
+UPLOAD_CACHE_PATH = Path.home() / '.claudeclario' / 'upload_cache.json'
+_UPLOAD_CACHE: Dict[str, tuple] = {}
+_UPLOAD_LOCK = threading.Lock()
+
+
+def _read_upload_index() -> Dict[str, tuple]:
+    """
+    Read the persisted upload index as {hash: (file name, expires_at)}, treating a missing or
+    corrupt file as empty and dropping entries that are not well formed.
+    """
     try:
-        analysis_prompt = f"""
-        Analyze this academic subject to determine the best learning approach and content transformation strategy:
+        with open(UPLOAD_CACHE_PATH, 'r', encoding='utf-8') as f:
+            raw_index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(raw_index, dict):
+        return {}
+
+    index = {}
+    for sha, entry in raw_index.items():
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            continue
+        try:
+            expires_at = datetime.fromisoformat(entry["expires_at"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if expires_at.tzinfo is None:  # can't be compared with our aware timestamps
+            continue
+        index[sha] = (entry["name"], expires_at)
+    return index
+
+
+def _persisted_upload(file_sha256: str, now: datetime):
+    """Fetch the handle of a live upload recorded by an earlier process, or None."""
+    entry = _read_upload_index().get(file_sha256)
+    if not entry:
+        return None
+    file_name, expires_at = entry
+    if expires_at <= now:
+        return None
+    try:
+        uploaded_file = genai.get_file(file_name)
+    except google_exceptions.GoogleAPICallError:
+        return None
+    # A file that failed or is still processing can't be used in a prompt; upload it again
+    if getattr(getattr(uploaded_file, "state", None), "name", None) != "ACTIVE":
+        return None
+    with _UPLOAD_LOCK:
+        _UPLOAD_CACHE[file_sha256] = (uploaded_file, expires_at)
+    return uploaded_file
+
+
+def _persist_upload(file_sha256: str, file_name: str, expires_at: datetime):
+    """Record an upload in the on-disk index, pruning expired and malformed entries."""
+    now = datetime.now(timezone.utc)
+    with _UPLOAD_LOCK:
+        index = {sha: {"name": name, "expires_at": entry_expires_at.isoformat()}
+                 for sha, (name, entry_expires_at) in _read_upload_index().items()
+                 if entry_expires_at > now}
+        index[file_sha256] = {"name": file_name, "expires_at": expires_at.isoformat()}
+        try:
+            os.makedirs(UPLOAD_CACHE_PATH.parent, exist_ok=True)
+            _atomic_write(UPLOAD_CACHE_PATH, json.dumps(index))
+        except OSError as e:
+            logger.warning("Could not persist upload cache: %s", e)
+
+
+def _upload_cached(file_path: str, display_name: str, file_sha256: str = None, refresh: bool = False):
+    """Upload a file to Gemini once per content hash and reuse the handle until it expires."""
+    file_sha256 = file_sha256 or _sha256_file(file_path)
+    now = datetime.now(timezone.utc)
+
+    if not refresh:
+        with _UPLOAD_LOCK:
+            cached = _UPLOAD_CACHE.get(file_sha256)
+        if cached and cached[1] > now:
+            return cached[0]
+        uploaded_file = _persisted_upload(file_sha256, now)
+        if uploaded_file is not None:
+            return uploaded_file
+
+    uploaded_file = genai.upload_file(path=file_path, display_name=display_name)
+    expires_at = now + GEMINI_FILE_LIFETIME
+    with _UPLOAD_LOCK:
+        _UPLOAD_CACHE[file_sha256] = (uploaded_file, expires_at)
+    _persist_upload(file_sha256, uploaded_file.name, expires_at)
+    return uploaded_file
+
+
+def _generate_with_uploaded_file(model, formatted_prompt: str, file_path: str, display_name: str,
+                                 file_sha256: str = None):
+    """Generate content against a (possibly cached) upload, re-uploading once if Gemini no longer has it."""
+    file_sha256 = file_sha256 or _sha256_file(file_path)
+    uploaded_file = _upload_cached(file_path, display_name, file_sha256)
+    try:
+        return _call_with_retry(model.generate_content, [formatted_prompt, uploaded_file])
+    except google_exceptions.NotFound:
+        uploaded_file = _upload_cached(file_path, display_name, file_sha256, refresh=True)
+        return _call_with_retry(model.generate_content, [formatted_prompt, uploaded_file])
+
 
-        Subject: {subject_name}
-        Description: {course_description}
+def _get_cached_pdf_model(file_sha256: str):
+    """Return a pro model bound to an existing server-side cache of this PDF, if still alive."""
+    with _PDF_CONTEXT_LOCK:
+        cache_name, _ = _PDF_CONTEXT_CACHES.get(file_sha256, (None, None))
+    if not cache_name:
+        return None
+
+    try:
+        cache = caching.CachedContent.get(cache_name)
+        cache.update(ttl=PDF_CONTEXT_CACHE_TTL)
+        return genai.GenerativeModel.from_cached_content(cached_content=cache)
+    except Exception as e:
+        logger.info("PDF context cache %s expired or unavailable: %s", cache_name, e)
+        with _PDF_CONTEXT_LOCK:
+            _PDF_CONTEXT_CACHES.pop(file_sha256, None)
+        return None
+
+
+def _create_cached_pdf_model(file_sha256: str, uploaded_file, display_name: str):
+    """Register the uploaded PDF as cached content and return a model bound to it, or None."""
+    model_name = _get_pro_model_name()
+    if not _is_versioned_model_name(model_name):
+        return None
+
+    now = datetime.now(timezone.utc)
+    with _PDF_CONTEXT_LOCK:
+        cache_name, retry_after = _PDF_CONTEXT_CACHES.get(file_sha256, (None, None))
+    if cache_name is None and retry_after is not None and now < retry_after:
+        return None
+
+    try:
+        cache = caching.CachedContent.create(
+            model=model_name,
+            display_name=display_name,
+            contents=[uploaded_file],
+            ttl=PDF_CONTEXT_CACHE_TTL
+        )
+    except Exception as e:
+        # Small documents fall under the minimum cacheable size; send them inline instead
+        logger.info("PDF context caching unavailable, sending file inline: %s", e)
+        with _PDF_CONTEXT_LOCK:
+            _PDF_CONTEXT_CACHES[file_sha256] = (None, now + PDF_CONTEXT_CACHE_RETRY_AFTER)
+        return None
+
+    with _PDF_CONTEXT_LOCK:
+        _PDF_CONTEXT_CACHES[file_sha256] = (cache.name, None)
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+
+# --- Instruction Context Cache ---
+INSTRUCTION_CACHE_TTL = timedelta(hours=1)
+# Gemini rejects caches below a minimum token count or on unversioned model aliases; don't retry every call
+INSTRUCTION_CACHE_RETRY_AFTER = timedelta(hours=1)
+_INSTRUCTION_CACHES: Dict[str, tuple] = {}  # key -> (CachedContent or None, expires_at or retry_after)
+_INSTRUCTION_CACHE_LOCK = threading.Lock()
+
+
+def _get_instruction_cached_model(key: str, model_name: str, system_instruction: str):
+    """
+    Return a model whose constant instructions are served from a server-side context cache,
+    creating the cache on first use, or None if Gemini will not cache them.
+    """
+    now = datetime.now(timezone.utc)
+    with _INSTRUCTION_CACHE_LOCK:
+        cache, deadline = _INSTRUCTION_CACHES.get(key, (None, None))
+    if cache is None and deadline is not None and now < deadline:
+        return None
+
+    if cache is not None and deadline > now:
+        if deadline - now < INSTRUCTION_CACHE_TTL / 2:
+            try:
+                cache.update(ttl=INSTRUCTION_CACHE_TTL)
+                with _INSTRUCTION_CACHE_LOCK:
+                    _INSTRUCTION_CACHES[key] = (cache, now + INSTRUCTION_CACHE_TTL)
+            except Exception as e:
+                logger.info("Instruction cache %s expired or unavailable: %s", cache.name, e)
+                cache = None
+        if cache is not None:
+            return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+    try:
+        cache = caching.CachedContent.create(
+            model=model_name,
+            display_name=key,
+            system_instruction=system_instruction,
+            ttl=INSTRUCTION_CACHE_TTL
+        )
+    except Exception as e:
+        logger.info("Instruction caching unavailable for %s, sending full prompts: %s", key, e)
+        with _INSTRUCTION_CACHE_LOCK:
+            _INSTRUCTION_CACHES[key] = (None, now + INSTRUCTION_CACHE_RETRY_AFTER)
+        return None
+
+    with _INSTRUCTION_CACHE_LOCK:
+        _INSTRUCTION_CACHES[key] = (cache, now + INSTRUCTION_CACHE_TTL)
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+
+# =========================================================================
+# --- Subject Analysis and Adaptation ---
+# =========================================================================
+
+_SUBJECT_ANALYSIS_INSTRUCTIONS = """
+        Analyze the academic subject given at the end of this prompt to determine the best learning approach and content transformation strategy.
 
         Determine and return JSON with:
-        {{
+        {
             "subject_domain": "economics|computer_science|mathematics|history|literature|psychology|engineering|medicine|law|business|physics|chemistry|biology|other",
             "learning_style": "theoretical|practical|mixed",
             "complexity_level": "undergraduate|masters|phd|professional",
@@ -107,17 +756,51 @@ def analyze_subject_domain(subject_name: str, course_description: str = "") -> D
             "real_world_connections": ["how concepts apply in practice", "current industry relevance"],
             "difficulty_factors": ["mathematical complexity", "abstract concepts", "memorization load", "etc."],
             "recommended_examples": ["types of examples that work best for this subject"]
-        }}
+        }
 
         Focus on understanding what makes this subject unique and how students in this field typically learn best.
         Return only valid JSON.
-        """
+"""
+
+
+def analyze_subject_domain(subject_name: str, course_description: str = "") -> Dict[str, Any]:
+    """
+    Analyze the subject to determine appropriate learning strategies and content types.
+    """
+    if not _is_api_configured():
+        return {"error": "Cannot analyze subject. Gemini API key is not configured."}
 
-        response = flash_model.generate_content(analysis_prompt)
-        cleaned_json = _clean_json_response(response.text)
-        return json.loads(cleaned_json)
+    cache_key = _subject_analysis_key(subject_name, course_description)
+    with _SUBJECT_ANALYSIS_LOCK:
+        cached = _SUBJECT_ANALYSIS_CACHE.get(cache_key)
+        if cached is not None:
+            _SUBJECT_ANALYSIS_CACHE.move_to_end(cache_key)
+    if cached is not None:
+        # Callers may annotate the analysis, so never hand out the cached object itself
+        return copy.deepcopy(cached)
 
+    try:
+        # Static instructions first so repeated calls share a cacheable prompt prefix
+        analysis_prompt = (f"{_SUBJECT_ANALYSIS_INSTRUCTIONS}\n"
+                           f"        Subject: {subject_name}\n"
+                           f"        Description: {course_description}\n")
+
+        response = _call_with_retry(_get_flash_model().generate_content, analysis_prompt)
+        analysis = _parse_json_response(response.text)
+
+        with _SUBJECT_ANALYSIS_LOCK:
+            _SUBJECT_ANALYSIS_CACHE[cache_key] = copy.deepcopy(analysis)
+            _SUBJECT_ANALYSIS_CACHE.move_to_end(cache_key)
+            while len(_SUBJECT_ANALYSIS_CACHE) > SUBJECT_ANALYSIS_CACHE_MAX_ENTRIES:
+                _SUBJECT_ANALYSIS_CACHE.popitem(last=False)
+        return analysis
+
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to analyze subject. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to analyze subject. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to analyze subject")
         return {"error": f"Failed to analyze subject. Reason: {e}"}
 
 
@@ -136,11 +819,13 @@ def process_pdf_and_extract_chapters(file_path: str, subject_name: str, course_d
             # Fallback to generic processing if analysis fails
             subject_analysis = _get_generic_subject_profile()
 
-        # Get domain configuration
-        domain_config = get_domain_config(subject_analysis.get("subject_domain", "general"))
-
-        # Upload the file
-        uploaded_file = genai.upload_file(path=file_path, display_name=subject_name)
+        # Reuse a live context cache for this PDF, otherwise upload and register one
+        file_sha256 = _sha256_file(file_path)
+        subject_domain = subject_analysis.get("subject_domain", "general")
+        cached_model = _get_cached_pdf_model(file_sha256)
+        if cached_model is None:
+            uploaded_file = _upload_cached(file_path, subject_name, file_sha256)
+            cached_model = _create_cached_pdf_model(file_sha256, uploaded_file, subject_name)
 
         # Load and format the extraction prompt template
         template = _load_prompt_template('adaptive_pdf_extraction.txt')
@@ -149,9 +834,8 @@ def process_pdf_and_extract_chapters(file_path: str, subject_name: str, course_d
 
         # Prepare template parameters
         prompt_params = {
+            **_domain_prompt_params(subject_domain),
             'subject_name': subject_name,
-            'subject_domain': subject_analysis.get("subject_domain", "general"),
-            'subject_domain_upper': subject_analysis.get("subject_domain", "general").upper().replace('_', ' '),
             'course_description': course_description,
             'learning_style': subject_analysis.get("learning_style", "mixed"),
             'complexity_level': subject_analysis.get("complexity_level", "intermediate"),
@@ -159,19 +843,19 @@ def process_pdf_and_extract_chapters(file_path: str, subject_name: str, course_d
             'career_applications': ', '.join(subject_analysis.get("career_applications", ["professional development"])),
             'visualization_types': ', '.join(subject_analysis.get("visualization_types", ["charts"])),
             'existing_books_context': format_existing_books_context(existing_books or []),
-            'domain_specific_instructions': domain_config.get("extraction_instructions",
-                                                              "Focus on clear explanations with practical examples"),
             'content_block_templates': get_content_block_templates(
-                subject_analysis.get("subject_domain", "general"),
-                subject_analysis.get("content_types", ["concepts"])
-            ),
-            'content_block_guidelines': domain_config.get("extraction_instructions", "")
+                subject_domain, subject_analysis.get("content_types", ["concepts"])
+            )
         }
 
         # Format the prompt
         formatted_prompt = _format_prompt_template(template, **prompt_params)
 
-        response = pro_model.generate_content([formatted_prompt, uploaded_file])
+        if cached_model is not None:
+            response = _call_with_retry(cached_model.generate_content, formatted_prompt)
+        else:
+            response = _generate_with_uploaded_file(_get_pro_model(), formatted_prompt, file_path, subject_name,
+                                                    file_sha256)
 
         if not response.parts:
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
@@ -179,51 +863,66 @@ def process_pdf_and_extract_chapters(file_path: str, subject_name: str, course_d
             return {
                 "error": "AI returned an empty response. This may be due to a safety block or an issue with the prompt."}
 
-        cleaned_json = _clean_json_response(response.text)
-        result = json.loads(cleaned_json)
+        result = _parse_json_response(response.text)
 
         # Add subject analysis metadata
         result["subject_analysis"] = subject_analysis
 
         return result
 
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to process PDF. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to process PDF. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to process PDF")
         return {"error": f"Failed to process PDF. Reason: {type(e).__name__}: {e}"}
 
 
-def answer_question_from_context(question: str, context: str, subject_domain: str = "general") -> str:
-    """Answer questions using modular Q&A prompt template."""
+def stream_answer_question_from_context(question: str, context: str, subject_domain: str = "general",
+                                        bypass_cache: bool = False) -> Iterator[str]:
+    """Answer questions using modular Q&A prompt template, yielding text chunks as they are generated."""
     if not _is_api_configured():
-        return "Error: Cannot answer question. Gemini API key is not configured or models unavailable."
+        yield StreamError("Error: Cannot answer question. Gemini API key is not configured or models unavailable.")
+        return
 
     try:
         # Load Q&A prompt template
         template = _load_prompt_template('adaptive_qa.txt')
         if not template:
-            return "Error: Could not load Q&A prompt template."
+            yield StreamError("Error: Could not load Q&A prompt template.")
+            return
 
         # Get domain configuration
-        domain_config = get_domain_config(subject_domain)
+        domain_config = _cached_get_domain_config(subject_domain)
 
         # Format the prompt
         formatted_prompt = _format_prompt_template(template,
                                                    subject_domain=subject_domain,
-                                                   subject_domain_upper=subject_domain.upper().replace('_', ' '),
+                                                   subject_domain_upper=_domain_upper(subject_domain),
                                                    context=context,
                                                    question=question,
                                                    domain_response_guidelines=domain_config.get("qa_guidelines",
                                                                                                 "Provide clear, helpful answers")
                                                    )
 
-        response = flash_model.generate_content(formatted_prompt)
-        return response.text
+        yield from _stream_text_cached(_get_flash_model(), formatted_prompt, bypass_cache)
 
+    except google_exceptions.GoogleAPICallError as e:
+        yield StreamError(f"Error: Could not get an answer from the AI. Gemini API error: {e}")
     except Exception as e:
-        return f"Error: Could not get an answer from the AI. Reason: {e}"
+        logger.exception("Could not get an answer from the AI")
+        yield StreamError(f"Error: Could not get an answer from the AI. Reason: {e}")
 
 
-def generate_quiz_from_summary(summary: str, subject_domain: str = "general", difficulty_level: str = "intermediate") -> \
-Optional[dict]:
+def answer_question_from_context(question: str, context: str, subject_domain: str = "general",
+                                 bypass_cache: bool = False) -> str:
+    """Answer questions using modular Q&A prompt template."""
+    return _join_stream(stream_answer_question_from_context(question, context, subject_domain, bypass_cache))
+
+
+def generate_quiz_from_summary(summary: str, subject_domain: str = "general", difficulty_level: str = "intermediate",
+                               bypass_cache: bool = False) -> Optional[dict]:
     """Generate domain-appropriate quiz using modular prompt template."""
     if not _is_api_configured():
         return {"error": "Cannot generate quiz. Gemini API key is not configured or models unavailable."}
@@ -235,28 +934,31 @@ Optional[dict]:
             return {"error": "Could not load quiz generation prompt template."}
 
         # Get domain configuration
-        domain_config = get_domain_config(subject_domain)
+        domain_config = _cached_get_domain_config(subject_domain)
 
         # Format the prompt
         formatted_prompt = _format_prompt_template(template,
                                                    subject_domain=subject_domain,
-                                                   subject_domain_upper=subject_domain.upper().replace('_', ' '),
+                                                   subject_domain_upper=_domain_upper(subject_domain),
                                                    difficulty_level=difficulty_level,
                                                    content_summary=summary,
                                                    domain_quiz_requirements=domain_config.get("quiz_requirements",
                                                                                               "Create comprehensive questions")
                                                    )
 
-        response = flash_model.generate_content(formatted_prompt)
-        cleaned_json = _clean_json_response(response.text)
-        return json.loads(cleaned_json)
+        return _generate_json_cached(_get_flash_model(), formatted_prompt, bypass_cache)
 
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to generate quiz. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to generate quiz. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to generate quiz")
         return {"error": f"Failed to generate quiz. Reason: {e}"}
 
 
-def generate_interactive_visualization(description: str, data_context: str, subject_domain: str = "general") -> \
-Optional[dict]:
+def generate_interactive_visualization(description: str, data_context: str, subject_domain: str = "general",
+                                       bypass_cache: bool = False) -> Optional[dict]:
     """Generate appropriate visualizations using modular prompt template."""
     if not _is_api_configured():
         return {"error": "Cannot generate visualization. Gemini API key is not configured or models unavailable."}
@@ -268,7 +970,7 @@ Optional[dict]:
             return {"error": "Could not load visualization generation prompt template."}
 
         # Get domain configuration
-        domain_config = get_domain_config(subject_domain)
+        domain_config = _cached_get_domain_config(subject_domain)
 
         # Format the prompt
         formatted_prompt = _format_prompt_template(template,
@@ -281,50 +983,63 @@ Optional[dict]:
                                                    visualization_type_recommendations=f"For {subject_domain}: {', '.join(domain_config.get('visualization_types', ['charts']))}"
                                                    )
 
-        response = flash_model.generate_content(formatted_prompt)
-        cleaned_json = _clean_json_response(response.text)
-        return json.loads(cleaned_json)
+        return _generate_json_cached(_get_flash_model(), formatted_prompt, bypass_cache)
 
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to generate visualization. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to generate visualization. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to generate visualization")
         return {"error": f"Failed to generate visualization. Reason: {e}"}
 
 
-def simplify_concept(concept_text: str, difficulty_level: str = "beginner", subject_domain: str = "general",
-                     learning_style: str = "mixed") -> str:
-    """Simplify concepts using modular prompt template."""
+def stream_simplify_concept(concept_text: str, difficulty_level: str = "beginner", subject_domain: str = "general",
+                            learning_style: str = "mixed", bypass_cache: bool = False) -> Iterator[str]:
+    """Simplify concepts using modular prompt template, yielding text chunks as they are generated."""
     if not _is_api_configured():
-        return "Error: Cannot simplify concept. Gemini API key is not configured or models unavailable."
+        yield StreamError("Error: Cannot simplify concept. Gemini API key is not configured or models unavailable.")
+        return
 
     try:
         # Load simplification prompt template
         template = _load_prompt_template('concept_simplification.txt')
         if not template:
-            return "Error: Could not load concept simplification prompt template."
+            yield StreamError("Error: Could not load concept simplification prompt template.")
+            return
 
-        # Get domain configuration
-        domain_config = get_domain_config(subject_domain)
+        # Get domain configuration and adaptation guidance
+        domain_config = _cached_get_domain_config(subject_domain)
+        difficulty_adaptations, learning_style_adaptations = _get_adaptations(difficulty_level, learning_style)
 
         # Format the prompt
         formatted_prompt = _format_prompt_template(template,
                                                    subject_domain=subject_domain,
-                                                   subject_domain_upper=subject_domain.upper().replace('_', ' '),
+                                                   subject_domain_upper=_domain_upper(subject_domain),
                                                    difficulty_level=difficulty_level,
                                                    learning_style=learning_style,
                                                    concept_text=concept_text,
                                                    domain_simplification_guidelines=domain_config.get(
                                                        "simplification_guidelines",
                                                        "Use clear, simple language with examples"),
-                                                   difficulty_adaptations=DIFFICULTY_ADAPTATIONS.get(difficulty_level,
-                                                                                                     "Adapt appropriately for level"),
-                                                   learning_style_adaptations=LEARNING_STYLE_ADAPTATIONS.get(
-                                                       learning_style, "Balance theory and practice")
+                                                   difficulty_adaptations=difficulty_adaptations,
+                                                   learning_style_adaptations=learning_style_adaptations
                                                    )
 
-        response = flash_model.generate_content(formatted_prompt)
-        return response.text
+        yield from _stream_text_cached(_get_flash_model(), formatted_prompt, bypass_cache)
 
+    except google_exceptions.GoogleAPICallError as e:
+        yield StreamError(f"Error: Could not simplify concept. Gemini API error: {e}")
     except Exception as e:
-        return f"Error: Could not simplify concept. Reason: {e}"
+        logger.exception("Could not simplify concept")
+        yield StreamError(f"Error: Could not simplify concept. Reason: {e}")
+
+
+def simplify_concept(concept_text: str, difficulty_level: str = "beginner", subject_domain: str = "general",
+                     learning_style: str = "mixed", bypass_cache: bool = False) -> str:
+    """Simplify concepts using modular prompt template."""
+    return _join_stream(stream_simplify_concept(concept_text, difficulty_level, subject_domain, learning_style,
+                                                bypass_cache))
 
 
 def _get_generic_subject_profile() -> Dict[str, Any]:
@@ -343,16 +1058,157 @@ def _get_generic_subject_profile() -> Dict[str, Any]:
     }
 
 
+# =========================================================================
+# --- Concurrent AI Workflows ---
+# =========================================================================
+
+async def aanalyze_subject_domain(subject_name: str, course_description: str = "") -> Dict[str, Any]:
+    """Async variant of analyze_subject_domain; runs the blocking call on a worker thread."""
+    return await asyncio.to_thread(analyze_subject_domain, subject_name, course_description)
+
+
+async def agenerate_quiz_from_summary(summary: str, subject_domain: str = "general",
+                                      difficulty_level: str = "intermediate") -> Optional[dict]:
+    """Async variant of generate_quiz_from_summary."""
+    return await asyncio.to_thread(generate_quiz_from_summary, summary, subject_domain, difficulty_level)
+
+
+async def agenerate_interactive_visualization(description: str, data_context: str,
+                                              subject_domain: str = "general") -> Optional[dict]:
+    """Async variant of generate_interactive_visualization."""
+    return await asyncio.to_thread(generate_interactive_visualization, description, data_context, subject_domain)
+
+
+async def asimplify_concept(concept_text: str, difficulty_level: str = "beginner", subject_domain: str = "general",
+                            learning_style: str = "mixed") -> str:
+    """Async variant of simplify_concept."""
+    return await asyncio.to_thread(simplify_concept, concept_text, difficulty_level, subject_domain, learning_style)
+
+
+async def process_chapter_bundle(summary: str, subject_domain: str = "general",
+                                 difficulty_level: str = "intermediate", learning_style: str = "mixed",
+                                 visualization_description: str = "") -> dict:
+    """
+    Generate the quiz, visualization and simplified explanation for a chapter concurrently.
+    Wall-clock time is bounded by the slowest call instead of the sum of all three.
+    """
+    quiz, visualization, simplified = await asyncio.gather(
+        agenerate_quiz_from_summary(summary, subject_domain, difficulty_level),
+        agenerate_interactive_visualization(visualization_description or summary, summary, subject_domain),
+        asimplify_concept(summary, difficulty_level, subject_domain, learning_style),
+        return_exceptions=True
+    )
+
+    if isinstance(quiz, BaseException):
+        quiz = {"error": f"Failed to generate quiz. Reason: {quiz}"}
+    if isinstance(visualization, BaseException):
+        visualization = {"error": f"Failed to generate visualization. Reason: {visualization}"}
+    if isinstance(simplified, BaseException):
+        simplified = f"Error: Could not simplify concept. Reason: {simplified}"
+
+    return {
+        "quiz": quiz,
+        "visualization": visualization,
+        "simplified": simplified
+    }
+
+
+CHAPTER_BATCH_CONCURRENCY = 8
+
+
+async def abatch_generate_chapter_artifacts(chapters: list, subject_domain: str = "general",
+                                            difficulty_level: str = "intermediate") -> list:
+    """
+    Generate the quiz and visualization for every chapter in one concurrent batch.
+    Each chapter is a dict with a 'summary' (and optionally 'title'); results keep the input order.
+    """
+    semaphore = asyncio.Semaphore(CHAPTER_BATCH_CONCURRENCY)
+
+    async def _bounded(coro):
+        async with semaphore:
+            return await coro
+
+    async def _chapter_artifacts(chapter: dict) -> dict:
+        summary = chapter.get("summary", "")
+        quiz, visualization = await asyncio.gather(
+            _bounded(agenerate_quiz_from_summary(summary, subject_domain, difficulty_level)),
+            _bounded(agenerate_interactive_visualization(chapter.get("title") or summary, summary, subject_domain))
+        )
+        return {"title": chapter.get("title"), "quiz": quiz, "visualization": visualization}
+
+    return await asyncio.gather(*(_chapter_artifacts(chapter) for chapter in chapters))
+
+
+def batch_generate_chapter_artifacts(chapters: list, subject_domain: str = "general",
+                                     difficulty_level: str = "intermediate") -> list:
+    """Blocking entry point to abatch_generate_chapter_artifacts."""
+    return asyncio.run(abatch_generate_chapter_artifacts(chapters, subject_domain, difficulty_level))
+
+
+def process_chapter_bundle_sync(summary: str, subject_domain: str = "general",
+                                difficulty_level: str = "intermediate", learning_style: str = "mixed",
+                                visualization_description: str = "") -> dict:
+    """Blocking entry point to process_chapter_bundle for synchronous callers such as Flask routes."""
+    return asyncio.run(process_chapter_bundle(summary, subject_domain, difficulty_level,
+                                              learning_style, visualization_description))
+
+
+async def aenhance_course_with_web_intelligence(course_name: str, university: str, student_input: dict) -> dict:
+    """Async variant of enhance_course_with_web_intelligence."""
+    return await asyncio.to_thread(enhance_course_with_web_intelligence, course_name, university, student_input)
+
+
+async def aprocess_pdf_with_web_intelligence(file_path: str, subject_name: str, course_name: str,
+                                             university: str, student_input: dict) -> dict:
+    """
+    Gather course intelligence and upload the PDF concurrently, then run the course-aware extraction.
+
+    The upload does not depend on the course context, so its latency is hidden behind the
+    intelligence call instead of being paid after it.
+    """
+    file_sha256 = await asyncio.to_thread(_sha256_file, file_path)
+    enhanced_context, _ = await asyncio.gather(
+        aenhance_course_with_web_intelligence(course_name, university, student_input),
+        # Warms the upload cache; a failure here is retried by the extraction call itself
+        asyncio.to_thread(_upload_cached, file_path, subject_name, file_sha256),
+        return_exceptions=True
+    )
+    if isinstance(enhanced_context, BaseException):
+        raise enhanced_context
+
+    return await asyncio.to_thread(process_pdf_with_course_intelligence, file_path, subject_name,
+                                   enhanced_context, file_sha256)
+
+
+def process_pdf_with_web_intelligence(file_path: str, subject_name: str, course_name: str,
+                                      university: str, student_input: dict) -> dict:
+    """Blocking entry point to aprocess_pdf_with_web_intelligence."""
+    return asyncio.run(aprocess_pdf_with_web_intelligence(file_path, subject_name, course_name,
+                                                          university, student_input))
+
+
 # =========================================================================
 # --- Prompt Management Functions ---
 # =========================================================================
 
+_PROMPT_LIST_CACHE: Dict[str, Any] = {}
+
+
 def list_available_prompts() -> list:
-    """List all available prompt templates."""
-    if not PROMPTS_DIR.exists():
+    """List all available prompt templates (cached until the prompts directory's mtime changes)."""
+    try:
+        mtime_ns = os.stat(PROMPTS_DIR).st_mtime_ns
+    except FileNotFoundError:
         return []
 
-    return [f.name for f in PROMPTS_DIR.glob('*.txt')]
+    if _PROMPT_LIST_CACHE.get('mtime_ns') != mtime_ns:
+        with os.scandir(PROMPTS_DIR) as entries:
+            names = tuple(e.name for e in entries if e.name.endswith('.txt') and e.is_file())
+        _PROMPT_LIST_CACHE.update(mtime_ns=mtime_ns, names=names)
+    return list(_PROMPT_LIST_CACHE['names'])
+
+
+_TEMPLATE_PARAM_RE = re.compile(r'{(\w+)}')
 
 
 def validate_prompt_template(prompt_name: str) -> dict:
@@ -361,10 +1217,9 @@ def validate_prompt_template(prompt_name: str) -> dict:
     if not template:
         return {"valid": False, "error": f"Template {prompt_name} not found"}
 
-    # Extract template parameters
-    import re
-    parameters = re.findall(r'{(\w+)}', template)
-    unique_params = list(set(parameters))
+    # Extract template parameters (order-preserving dedupe)
+    parameters = _TEMPLATE_PARAM_RE.findall(template)
+    unique_params = list(dict.fromkeys(parameters))
 
     return {
         "valid": True,
@@ -374,15 +1229,38 @@ def validate_prompt_template(prompt_name: str) -> dict:
     }
 
 
+# Read once at import: os.umask can only be queried by setting it, which would race with other threads
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _atomic_write(path: Path, content: str):
+    """Write to a temp file in the same directory and rename it over path, so readers never see a partial file."""
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, prefix=f".{path.name}.",
+                                     suffix='.tmp', delete=False) as tmp:
+        tmp.write(content)
+    try:
+        # The temp file is created 0600; keep the mode a plain open() would have left on path
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp.name, mode)
+        os.replace(tmp.name, path)
+    except OSError:
+        os.unlink(tmp.name)
+        raise
+
+
 def create_custom_prompt_template(prompt_name: str, template_content: str) -> bool:
     """Create a new custom prompt template."""
     try:
         os.makedirs(PROMPTS_DIR, exist_ok=True)
-        with open(PROMPTS_DIR / prompt_name, 'w', encoding='utf-8') as f:
-            f.write(template_content)
+        _atomic_write(PROMPTS_DIR / prompt_name, template_content)
+        _load_prompt_template.cache_clear()
         return True
     except Exception as e:
-        print(f"Error creating prompt template: {e}")
+        logger.error("Error creating prompt template: %s", e)
         return False
 
 
@@ -390,15 +1268,15 @@ def update_prompt_template(prompt_name: str, template_content: str) -> bool:
     """Update an existing prompt template."""
     template_path = PROMPTS_DIR / prompt_name
     if not template_path.exists():
-        print(f"Template {prompt_name} does not exist. Use create_custom_prompt_template instead.")
+        logger.warning("Template %s does not exist. Use create_custom_prompt_template instead.", prompt_name)
         return False
 
     try:
-        with open(template_path, 'w', encoding='utf-8') as f:
-            f.write(template_content)
+        _atomic_write(template_path, template_content)
+        _load_prompt_template.cache_clear()
         return True
     except Exception as e:
-        print(f"Error updating prompt template: {e}")
+        logger.error("Error updating prompt template: %s", e)
         return False
 
 
@@ -431,16 +1309,18 @@ def add_custom_domain_config(domain_name: str, config: dict) -> bool:
     """Add a custom domain configuration (runtime only)."""
     try:
         from domain_configurations import DOMAIN_CONFIGURATIONS
-        DOMAIN_CONFIGURATIONS[domain_name] = config
+        DOMAIN_CONFIGURATIONS[domain_name] = MappingProxyType(dict(config))
+        _cached_get_domain_config.cache_clear()
+        _domain_prompt_params.cache_clear()
         return True
     except Exception as e:
-        print(f"Error adding custom domain config: {e}")
+        logger.error("Error adding custom domain config: %s", e)
         return False
 
 
 def get_domain_info(domain_name: str) -> dict:
     """Get detailed information about a domain configuration."""
-    domain_config = get_domain_config(domain_name)
+    domain_config = _cached_get_domain_config(domain_name)
     validation_info = {
         "domain_exists": domain_name in get_supported_domains(),
         "display_name": domain_config.get("display_name", "Unknown"),
@@ -460,109 +1340,233 @@ def get_domain_info(domain_name: str) -> dict:
 # --- Web Intelligence Integration ---
 # =========================================================================
 
-def gather_web_course_intelligence(course_name: str, university: str = "", course_code: str = "") -> dict:
-    """
-    Gather course intelligence from web sources to enhance PDF processing context.
-    This provides the AI with comprehensive course understanding before processing any PDFs.
-
-    Args:
-        course_name: Name of the course (e.g., "Advanced Microeconomics")
-        university: University name (e.g., "Harvard University")
-        course_code: Course code if available (e.g., "ECON 2010")
-
-    Returns:
-        Dict with comprehensive course intelligence including:
-        - Course description and objectives
-        - Typical textbook sequences
-        - Prerequisites and follow-up courses
-        - Career applications and industry relevance
-        - Academic standards and expectations
-    """
-    if not _is_api_configured():
-        return {"error": "Cannot gather course intelligence. Gemini API key not configured."}
-
-    try:
-        # Create a comprehensive course research prompt
-        intelligence_prompt = f"""
-        Research and provide comprehensive intelligence about this academic course:
-
-        Course: {course_name}
-        University: {university or "General academic standards"}
-        Course Code: {course_code or "Not specified"}
-
-        Based on your knowledge of academic curricula, provide detailed course intelligence:
-
-        {{
-            "course_overview": {{
+_COURSE_INTELLIGENCE_SCHEMA = """
+        {
+            "course_overview": {
                 "official_description": "Comprehensive description of what this course covers",
                 "learning_objectives": ["Primary learning goal 1", "Primary learning goal 2", "etc."],
                 "academic_level": "undergraduate|masters|phd|professional",
                 "typical_duration": "semester length and time commitment",
                 "difficulty_rating": "1-10 scale with explanation"
-            }},
+            },
 
-            "curriculum_structure": {{
+            "curriculum_structure": {
                 "typical_textbooks": ["Primary textbook authors/titles", "Secondary references"],
                 "chapter_sequence": ["Typical chapter progression", "Topic ordering"],
                 "prerequisites": ["Required background knowledge", "Prerequisite courses"],
                 "follow_up_courses": ["Natural next courses", "Advanced topics"]
-            }},
+            },
 
-            "subject_domain_analysis": {{
+            "subject_domain_analysis": {
                 "primary_domain": "economics|computer_science|mathematics|etc.",
                 "subdisciplines": ["Specific areas within the domain"],
                 "methodological_approach": "theoretical|practical|mixed",
                 "mathematical_intensity": "low|medium|high",
                 "memorization_vs_analysis": "ratio and explanation"
-            }},
+            },
 
-            "career_applications": {{
+            "career_applications": {
                 "primary_career_paths": ["Most common career destinations"],
                 "industry_applications": ["How concepts are used professionally"],
                 "salary_impact": "How this knowledge affects earning potential",
                 "skill_development": ["Professional skills gained"],
                 "certification_relevance": ["Professional certifications this supports"]
-            }},
+            },
 
-            "academic_context": {{
-                "university_approach": "How {university or 'top universities'} typically teach this",
+            "academic_context": {
+                "university_approach": "How this university (or top universities, if none is given) typically teaches this",
                 "research_connections": ["How this connects to current research"],
                 "interdisciplinary_links": ["Connections to other fields"],
                 "global_variations": ["How this course varies internationally"],
                 "current_trends": ["Recent developments in the field"]
-            }},
+            },
 
-            "learning_optimization": {{
+            "learning_optimization": {
                 "effective_study_methods": ["Best approaches for mastering this subject"],
                 "common_difficulties": ["Where students typically struggle"],
                 "success_strategies": ["What leads to high performance"],
                 "resource_recommendations": ["Additional learning resources"],
                 "assessment_approaches": ["Typical exam and project formats"]
-            }}
-        }}
+            }
+        }
+"""
 
+# Static instructions and schema form a byte-identical prefix; only the course details vary per call
+_COURSE_INTELLIGENCE_INSTRUCTIONS = """
+        Research and provide comprehensive intelligence about the academic course given at the end of this prompt.
+        Based on your knowledge of academic curricula, provide detailed course intelligence in this JSON format:
+""" + _COURSE_INTELLIGENCE_SCHEMA + """
         Provide specific, actionable intelligence that would help an AI tutor create the most effective learning experience for students in this course.
         Return only valid JSON without markdown formatting.
-        """
+"""
+_COURSE_INTELLIGENCE_DETAILS = string.Template("""
+        Course: ${course_name}
+        University: ${university}
+        Course Code: ${course_code}
+        """)
+_COURSE_INTELLIGENCE_PROMPT = string.Template(_COURSE_INTELLIGENCE_INSTRUCTIONS + _COURSE_INTELLIGENCE_DETAILS.template)
+
+_COURSE_INTELLIGENCE_BATCH_PROMPT = string.Template("""
+        Research and provide comprehensive intelligence about each academic course listed at the end of this prompt.
+        Based on your knowledge of academic curricula, return a JSON array where element i is the course intelligence
+        for course i, each element in this JSON format:
+""" + _COURSE_INTELLIGENCE_SCHEMA + """
+        Provide specific, actionable intelligence that would help an AI tutor create the most effective learning experience for students in each course.
+        Return only a valid JSON array with exactly ${course_count} elements, without markdown formatting.
+
+        Courses:
+${course_lines}
+        """)
+
+
+def _finalize_course_intelligence(course_intelligence: dict, cache_key: str) -> dict:
+    """Attach domain configuration and provenance to raw course intelligence and cache it."""
+    # Enhance with domain-specific configurations
+    detected_domain = course_intelligence.get("subject_domain_analysis", {}).get("primary_domain", "general")
+    domain_config = _cached_get_domain_config(detected_domain)
+
+    # One clock read stamps the result and dates its cache entry
+    now = datetime.now(timezone.utc)
+    course_intelligence["domain_configuration"] = dict(domain_config)  # the shared config is read-only
+    course_intelligence["intelligence_source"] = "ai_research"
+    course_intelligence["generated_at"] = now.isoformat()
+
+    with _COURSE_INTELLIGENCE_LOCK:
+        _COURSE_INTELLIGENCE_CACHE[cache_key] = (copy.deepcopy(course_intelligence),
+                                                 now + COURSE_INTELLIGENCE_CACHE_TTL)
+    return course_intelligence
+
+
+def gather_web_course_intelligence(course_name: str, university: str = "", course_code: str = "",
+                                   bypass_cache: bool = False) -> dict:
+    """
+    Gather course intelligence from web sources to enhance PDF processing context.
+    This provides the AI with comprehensive course understanding before processing any PDFs.
+
+    Args:
+        course_name: Name of the course (e.g., "Advanced Microeconomics")
+        university: University name (e.g., "Harvard University")
+        course_code: Course code if available (e.g., "ECON 2010")
+
+    Returns:
+        Dict with comprehensive course intelligence including:
+        - Course description and objectives
+        - Typical textbook sequences
+        - Prerequisites and follow-up courses
+        - Career applications and industry relevance
+        - Academic standards and expectations
+    """
+    if not _is_api_configured():
+        return {"error": "Cannot gather course intelligence. Gemini API key not configured."}
 
-        response = flash_model.generate_content(intelligence_prompt)
-        cleaned_json = _clean_json_response(response.text)
-        course_intelligence = json.loads(cleaned_json)
+    cache_key = _course_intelligence_key(course_name, university, course_code)
+    if not bypass_cache:
+        cached = _get_cached_course_intelligence(cache_key)
+        if cached is not None:
+            return cached
 
-        # Enhance with domain-specific configurations
-        detected_domain = course_intelligence.get("subject_domain_analysis", {}).get("primary_domain", "general")
-        domain_config = get_domain_config(detected_domain)
+    # Concurrent requests for the same course share one Gemini call while the cache is still cold
+    return _coalesce(f"course-intelligence:{cache_key}", _research_course_intelligence,
+                     course_name, university, course_code, cache_key, bypass_cache)
 
-        course_intelligence["domain_configuration"] = domain_config
-        course_intelligence["intelligence_source"] = "ai_research"
-        course_intelligence["generated_at"] = datetime.now().isoformat()
 
-        return course_intelligence
+def _research_course_intelligence(course_name: str, university: str, course_code: str, cache_key: str,
+                                  bypass_cache: bool) -> dict:
+    """Ask Gemini for course intelligence and cache the finalized result."""
+    try:
+        course_details = {
+            "course_name": course_name,
+            "university": university or "General academic standards",
+            "course_code": course_code or "Not specified"
+        }
 
+        # Prefer sending only the course details against server-side cached instructions
+        cached_model = _get_instruction_cached_model("course-intelligence", _get_flash_model_name(),
+                                                     _COURSE_INTELLIGENCE_INSTRUCTIONS)
+        if cached_model is not None:
+            course_intelligence = _generate_json_cached(
+                cached_model, _COURSE_INTELLIGENCE_DETAILS.substitute(course_details), bypass_cache)
+        else:
+            course_intelligence = _generate_json_cached(
+                _get_flash_model(), _COURSE_INTELLIGENCE_PROMPT.substitute(course_details), bypass_cache)
+        return _finalize_course_intelligence(course_intelligence, cache_key)
+
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to gather course intelligence. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to gather course intelligence. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to gather course intelligence")
         return {"error": f"Failed to gather course intelligence. Reason: {e}"}
 
 
+# Courses per Gemini call; keeps each response comfortably inside the output token limit
+COURSE_INTELLIGENCE_BATCH_SIZE = 8
+
+
+def gather_web_course_intelligence_batch(courses: list, bypass_cache: bool = False) -> list:
+    """
+    Gather course intelligence for many courses, sending uncached courses to Gemini in groups
+    so the research instructions and schema are paid once per group instead of once per course.
+
+    Args:
+        courses: List of (course_name, university, course_code) tuples
+        bypass_cache: Ignore cached intelligence and research every course again
+
+    Returns:
+        List of course intelligence dicts (or {"error": ...} dicts) in the same order as courses
+    """
+    if not _is_api_configured():
+        return [{"error": "Cannot gather course intelligence. Gemini API key not configured."} for _ in courses]
+
+    results = [None] * len(courses)
+    pending = {}  # cache key -> (course triple, indices needing it)
+    for index, (course_name, university, course_code) in enumerate(courses):
+        cache_key = _course_intelligence_key(course_name, university, course_code)
+        cached = None if bypass_cache else _get_cached_course_intelligence(cache_key)
+        if cached is not None:
+            results[index] = cached
+        elif cache_key in pending:
+            pending[cache_key][1].append(index)
+        else:
+            pending[cache_key] = ((course_name, university, course_code), [index])
+
+    groups = list(pending.items())
+    for start in range(0, len(groups), COURSE_INTELLIGENCE_BATCH_SIZE):
+        group = groups[start:start + COURSE_INTELLIGENCE_BATCH_SIZE]
+        course_lines = "\n".join(
+            f"        {i}) Course: {name} | University: {university or 'General academic standards'} | "
+            f"Course Code: {code or 'Not specified'}"
+            for i, (_, ((name, university, code), _)) in enumerate(group, 1)
+        )
+        batch_prompt = _COURSE_INTELLIGENCE_BATCH_PROMPT.substitute(course_count=len(group),
+                                                                    course_lines=course_lines)
+
+        try:
+            batch = _generate_json_cached(_get_flash_model(), batch_prompt, bypass_cache)
+            if not isinstance(batch, list) or len(batch) != len(group):
+                raise ValueError(f"expected a JSON array of {len(group)} course objects")
+            for (cache_key, (_, indices)), course_intelligence in zip(group, batch):
+                course_intelligence = _finalize_course_intelligence(course_intelligence, cache_key)
+                for index in indices:
+                    results[index] = copy.deepcopy(course_intelligence)
+        except google_exceptions.GoogleAPICallError as e:
+            for _, (_, indices) in group:
+                for index in indices:
+                    results[index] = {"error": f"Failed to gather course intelligence. Gemini API error: {e}"}
+        except (ValueError, AttributeError) as e:
+            # Malformed or misaligned batch output; fall back to one call per course for this group
+            logger.warning("Batched course intelligence failed (%s); researching %d courses individually",
+                           e, len(group))
+            for _, ((course_name, university, course_code), indices) in group:
+                course_intelligence = gather_web_course_intelligence(course_name, university, course_code,
+                                                                     bypass_cache)
+                for index in indices:
+                    results[index] = copy.deepcopy(course_intelligence)
+
+    return results
+
+
 def enhance_course_with_web_intelligence(course_name: str, university: str, student_input: dict) -> dict:
     """
     Combine student input with AI-researched course intelligence to create
@@ -595,29 +1599,38 @@ def enhance_course_with_web_intelligence(course_name: str, university: str, stud
     return enhanced_context
 
 
-def _create_fallback_course_context(course_name: str, university: str) -> dict:
-    """Create basic course context when web intelligence fails."""
+@lru_cache(maxsize=1)
+def _domain_keyword_matcher() -> tuple:
+    """
+    Compile DOMAIN_KEYWORDS into one regex that reports a keyword at every position it occurs,
+    plus the best domain rank implied by each keyword.
+    """
+    domains = list(DOMAIN_KEYWORDS)
+    keyword_ranks = {}
+    for rank, keywords in enumerate(DOMAIN_KEYWORDS.values()):
+        for keyword in keywords:
+            keyword_ranks.setdefault(keyword, rank)
+
+    # Alternatives are tried longest first, so a match also implies every keyword that is a prefix of it
+    best_ranks = {keyword: min(rank for other, rank in keyword_ranks.items() if keyword.startswith(other))
+                  for keyword in keyword_ranks}
+    alternation = '|'.join(re.escape(keyword) for keyword in sorted(keyword_ranks, key=len, reverse=True))
+    return re.compile(f'(?=({alternation}))'), best_ranks, domains
 
-    # Basic domain detection from course name
-    domain_keywords = {
-        "economics": ["economics", "econometrics", "macro", "micro", "finance"],
-        "computer_science": ["computer", "programming", "algorithms", "data", "software"],
-        "mathematics": ["mathematics", "calculus", "algebra", "statistics", "math"],
-        "psychology": ["psychology", "behavioral", "cognitive", "social"],
-        "business": ["business", "management", "marketing", "strategy", "mba"],
-        "engineering": ["engineering", "mechanical", "electrical", "civil"],
-        "medicine": ["medicine", "medical", "anatomy", "physiology", "clinical"]
-    }
 
-    detected_domain = "general"
-    course_lower = course_name.lower()
+def _detect_domain_from_keywords(text: str) -> str:
+    """Highest-priority domain with a keyword occurring anywhere in text, or 'general'."""
+    pattern, best_ranks, domains = _domain_keyword_matcher()
+    best = min((best_ranks[match.group(1)] for match in pattern.finditer(text.lower())), default=None)
+    return domains[best] if best is not None else "general"
 
-    for domain, keywords in domain_keywords.items():
-        if any(keyword in course_lower for keyword in keywords):
-            detected_domain = domain
-            break
 
-    domain_config = get_domain_config(detected_domain)
+def _create_fallback_course_context(course_name: str, university: str) -> dict:
+    """Create basic course context when web intelligence fails."""
+
+    # Basic domain detection from course name
+    detected_domain = _detect_domain_from_keywords(course_name)
+    domain_config = _cached_get_domain_config(detected_domain)
 
     return {
         "course_overview": {
@@ -638,40 +1651,57 @@ def _create_fallback_course_context(course_name: str, university: str) -> dict:
     }
 
 
+# Shared read-only default for missing sections of course intelligence
+_EMPTY = MappingProxyType({})
+
+
+def _merge_unique(*lists) -> list:
+    """
+    Merge lists in order, dropping duplicates; strings compare case- and whitespace-insensitively
+    and keep their first-seen form, so the merged order (and any prompt built from it) is stable.
+    """
+    merged = {}
+    for items in lists:
+        for item in items:
+            key = item.strip().lower() if isinstance(item, str) else item
+            merged.setdefault(key, item)
+    return list(merged.values())
+
+
 def _synthesize_course_context(student_input: dict, web_intelligence: dict) -> dict:
     """
     Synthesize student input with web intelligence to create optimal course context.
     """
 
+    overview = web_intelligence.get("course_overview") or _EMPTY
+    curriculum = web_intelligence.get("curriculum_structure") or _EMPTY
+    careers = web_intelligence.get("career_applications") or _EMPTY
+    analysis = web_intelligence.get("subject_domain_analysis") or _EMPTY
+
     synthesis = {
         "course_name": student_input.get("course_name", ""),
         "university": student_input.get("university", ""),
-        "academic_level": student_input.get("academic_level",
-                                            web_intelligence.get("course_overview", {}).get("academic_level",
-                                                                                            "masters")),
+        "academic_level": student_input.get("academic_level", overview.get("academic_level", "masters")),
 
         # Merge learning objectives
-        "learning_objectives": list(set(
-            student_input.get("learning_objectives", []) +
-            web_intelligence.get("course_overview", {}).get("learning_objectives", [])
-        )),
+        "learning_objectives": _merge_unique(
+            student_input.get("learning_objectives", []),
+            overview.get("learning_objectives", [])
+        ),
 
         # Career focus
-        "career_focus": student_input.get("career_goals",
-                                          web_intelligence.get("career_applications", {}).get("primary_career_paths",
-                                                                                              [])),
+        "career_focus": student_input.get("career_goals", careers.get("primary_career_paths", [])),
 
         # Subject domain
-        "subject_domain": web_intelligence.get("subject_domain_analysis", {}).get("primary_domain", "general"),
+        "subject_domain": analysis.get("primary_domain", "general"),
 
         # Prerequisites and context
-        "prerequisites": web_intelligence.get("curriculum_structure", {}).get("prerequisites", []),
-        "follow_up_courses": web_intelligence.get("curriculum_structure", {}).get("follow_up_courses", []),
+        "prerequisites": curriculum.get("prerequisites", []),
+        "follow_up_courses": curriculum.get("follow_up_courses", []),
 
         # Learning approach
-        "methodological_approach": web_intelligence.get("subject_domain_analysis", {}).get("methodological_approach",
-                                                                                           "mixed"),
-        "difficulty_level": web_intelligence.get("course_overview", {}).get("difficulty_rating", "intermediate")
+        "methodological_approach": analysis.get("methodological_approach", "mixed"),
+        "difficulty_level": overview.get("difficulty_rating", "intermediate")
     }
 
     return synthesis
@@ -681,7 +1711,8 @@ def _synthesize_course_context(student_input: dict, web_intelligence: dict) -> d
 # --- Enhanced PDF Processing with Course Intelligence ---
 # =========================================================================
 
-def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enhanced_course_context: dict) -> dict:
+def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enhanced_course_context: dict,
+                                         file_sha256: str = None) -> dict:
     """
     Enhanced PDF processing that uses comprehensive course intelligence
     to create contextually aware, curriculum-integrated content.
@@ -690,6 +1721,7 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
         file_path: Path to PDF file
         subject_name: Name of the subject/book
         enhanced_course_context: Result from enhance_course_with_web_intelligence()
+        file_sha256: Precomputed content hash of the PDF, if the caller already has it
 
     Returns:
         Processed content with full course context integration
@@ -697,15 +1729,17 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
     if not _is_api_configured():
         return {"error": "Cannot process PDF. Gemini API key is not configured or models unavailable."}
 
+    upload_pool = ThreadPoolExecutor(max_workers=1)
     try:
+        # Start the upload now so it overlaps with building the prompt
+        file_sha256 = file_sha256 or _sha256_file(file_path)
+        upload_future = upload_pool.submit(_upload_cached, file_path, subject_name, file_sha256)
+
         # Extract course intelligence
         course_synthesis = enhanced_course_context.get("synthesis", {})
         web_intelligence = enhanced_course_context.get("web_intelligence", {})
         student_input = enhanced_course_context.get("student_provided", {})
 
-        # Upload the file
-        uploaded_file = genai.upload_file(path=file_path, display_name=subject_name)
-
         # Load and format the extraction prompt template with full context
         template = _load_prompt_template('adaptive_pdf_extraction.txt')
         if not template:
@@ -713,18 +1747,17 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
 
         # Get domain configuration
         subject_domain = course_synthesis.get("subject_domain", "general")
-        domain_config = get_domain_config(subject_domain)
+        domain_config = _cached_get_domain_config(subject_domain)
 
         # Build comprehensive course context for the prompt
         course_context_prompt = _build_course_context_prompt(enhanced_course_context)
 
         # Prepare template parameters with enhanced context
         prompt_params = {
+            **_domain_prompt_params(subject_domain),
             'subject_name': subject_name,
-            'subject_domain': subject_domain,
-            'subject_domain_upper': subject_domain.upper().replace('_', ' '),
-            'course_description': course_synthesis.get("course_name", "") + " - " +
-                                  str(web_intelligence.get("course_overview", {}).get("official_description", "")),
+            'course_description': f'{course_synthesis.get("course_name", "")} - '
+                                  f'{(web_intelligence.get("course_overview") or _EMPTY).get("official_description", "")}',
             'learning_style': course_synthesis.get("methodological_approach", "mixed"),
             'complexity_level': course_synthesis.get("academic_level", "intermediate"),
             'content_types': ', '.join(domain_config.get("content_types", ["concepts", "examples"])),
@@ -740,7 +1773,10 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
         # Format the prompt with comprehensive context
         formatted_prompt = _format_prompt_template(template, **prompt_params)
 
-        response = pro_model.generate_content([formatted_prompt, uploaded_file])
+        # Wait for the upload (surfacing its errors), then generate against the cached handle
+        upload_future.result()
+        response = _generate_with_uploaded_file(_get_pro_model(), formatted_prompt, file_path, subject_name,
+                                                file_sha256)
 
         if not response.parts:
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
@@ -748,8 +1784,7 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
             return {
                 "error": "AI returned an empty response. This may be due to a safety block or an issue with the prompt."}
 
-        cleaned_json = _clean_json_response(response.text)
-        result = json.loads(cleaned_json)
+        result = _parse_json_response(response.text)
 
         # Add enhanced metadata
         result["course_intelligence"] = enhanced_course_context
@@ -757,13 +1792,21 @@ def process_pdf_with_course_intelligence(file_path: str, subject_name: str, enha
             "subject_domain_detected": subject_domain,
             "course_context_used": True,
             "web_intelligence_available": "web_intelligence" in enhanced_course_context,
-            "processing_timestamp": datetime.now().isoformat()
+            "processing_timestamp": datetime.now(timezone.utc).isoformat()
         }
 
         return result
 
+    except google_exceptions.GoogleAPICallError as e:
+        return {"error": f"Failed to process PDF with course intelligence. Gemini API error: {e}"}
+    except json.JSONDecodeError as e:
+        return {"error": f"Failed to process PDF with course intelligence. AI returned malformed JSON: {e}"}
     except Exception as e:
+        logger.exception("Failed to process PDF with course intelligence")
         return {"error": f"Failed to process PDF with course intelligence. Reason: {type(e).__name__}: {e}"}
+    finally:
+        # Don't block on an upload left running by an early return; it still warms the upload cache
+        upload_pool.shutdown(wait=False)
 
 
 def _build_course_context_prompt(enhanced_course_context: dict) -> str:
@@ -775,8 +1818,8 @@ def _build_course_context_prompt(enhanced_course_context: dict) -> str:
     context_parts = []
 
     # Course overview
-    if web_intelligence.get("course_overview"):
-        overview = web_intelligence["course_overview"]
+    overview = web_intelligence.get("course_overview")
+    if overview:
         context_parts.append(f"""
 COURSE OVERVIEW:
 - {synthesis.get('course_name', 'Unknown Course')} at {synthesis.get('university', 'Institution')}
@@ -786,8 +1829,8 @@ COURSE OVERVIEW:
 """)
 
     # Curriculum context
-    if web_intelligence.get("curriculum_structure"):
-        curriculum = web_intelligence["curriculum_structure"]
+    curriculum = web_intelligence.get("curriculum_structure")
+    if curriculum:
         context_parts.append(f"""
 CURRICULUM CONTEXT:
 - Prerequisites: {', '.join(curriculum.get('prerequisites', ['None specified']))}
@@ -796,10 +1839,11 @@ CURRICULUM CONTEXT:
 """)
 
     # Career context
-    if synthesis.get("career_focus"):
+    career_focus = synthesis.get("career_focus")
+    if career_focus:
         context_parts.append(f"""
 CAREER FOCUS:
-- Target Career Paths: {', '.join(synthesis.get('career_focus', []))}
+- Target Career Paths: {', '.join(career_focus)}
 - Industry Applications: Focus on practical applications for these career goals
 """)
 
@@ -844,8 +1888,15 @@ def _build_content_guidelines(domain_config: dict, course_synthesis: dict) -> st
 # --- Utility Functions ---
 # =========================================================================
 
-def test_ai_service_connection() -> dict:
-    """Test the AI service connection and return status."""
+# Health probes are cached so liveness checks don't cost a Gemini call each; failures expire sooner
+HEALTH_CHECK_TTL = 30.0  # seconds
+HEALTH_CHECK_FAILURE_TTL = 5.0  # seconds
+_HEALTH_CACHE = {"checked_at": 0.0, "ttl": 0.0, "result": None}
+_HEALTH_LOCK = threading.Lock()
+
+
+def test_ai_service_connection(force_refresh: bool = False) -> dict:
+    """Test the AI service connection and return status, reusing a recent probe result unless force_refresh."""
 
     if not _is_api_configured():
         return {
@@ -854,9 +1905,27 @@ def test_ai_service_connection() -> dict:
             "configured": False
         }
 
+    # Holding the lock through the probe also collapses concurrent probes into one Gemini call
+    with _HEALTH_LOCK:
+        now = time.monotonic()
+        if (not force_refresh and _HEALTH_CACHE["result"] is not None
+                and now - _HEALTH_CACHE["checked_at"] < _HEALTH_CACHE["ttl"]):
+            return copy.deepcopy(_HEALTH_CACHE["result"])
+
+        result = _probe_ai_service()
+        _HEALTH_CACHE.update(
+            checked_at=time.monotonic(),
+            ttl=HEALTH_CHECK_TTL if result["status"] == "success" else HEALTH_CHECK_FAILURE_TTL,
+            result=copy.deepcopy(result)
+        )
+        return result
+
+
+def _probe_ai_service() -> dict:
+    """Send a single live test prompt to Gemini and describe the outcome."""
     try:
         # Test basic AI functionality
-        test_response = flash_model.generate_content("Respond with 'AI service working' if you can read this.")
+        test_response = _get_flash_model().generate_content("Respond with 'AI service working' if you can read this.")
 
         return {
             "status": "success",
@@ -891,8 +1960,8 @@ def get_ai_service_stats() -> dict:
             "supported_domains": len(get_supported_domains()),
             "available_prompts": len(list_available_prompts()),
             "models_available": {
-                "pro_model": pro_model is not None,
-                "flash_model": flash_model is not None
+                "pro_model": _get_pro_model() is not None,
+                "flash_model": _get_flash_model() is not None
             }
         },
         "capabilities": {
@@ -903,6 +1972,10 @@ def get_ai_service_stats() -> dict:
             "course_context": True,
             "interactive_visualizations": True
         },
+        "cache_stats": {
+            "course_intelligence": dict(_COURSE_INTELLIGENCE_STATS,
+                                        entries=len(_COURSE_INTELLIGENCE_CACHE))
+        },
         "supported_domains": get_supported_domains(),
         "prompt_templates": list_available_prompts()
     }
\ No newline at end of file
@@ -1,27 +1,133 @@
 import os
 os.environ['GRPC_ENABLE_FORK_SUPPORT'] = "false"
+import hashlib
 import json
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, jsonify
+import logging
+import sqlite3
+import tempfile
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from flask import (
+    Flask, Request, current_app, g, make_response, render_template, request, redirect, url_for, flash, abort,
+    session, jsonify
+)
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
+from sqlalchemy import DateTime, Integer, case, cast, event, func, insert, literal, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager, defer, selectinload
 from datetime import datetime, timedelta
 from models import (
     db, Course, Subject, Chapter, CourseEnrollment, UserProgress, Bookmark,
-    QuizResult, StudySession, update_course_stats, update_subject_stats,
-    update_chapter_stats, get_user_course_progress, get_adaptive_recommendations
+    QuizResult, StruggleArea, StudySession, StudyActivity, UploadJob, json_dumps, json_loads, ensure_schema,
+    update_course_stats, update_subject_stats, content_block_counts,
+    get_user_course_progress, get_user_course_progress_batch, get_cached_adaptive_recommendations,
+    invalidate_adaptive_recommendations
 )
 import ai_service
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; Flask's stdlib provider is used instead
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Enable WAL so readers are not blocked by the writer on the shared SQLite file."""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")  # ~64MB page cache
+    cursor.close()
+
+
+COURSE_INTELLIGENCE_MAX_AGE = 24 * 60 * 60  # seconds browsers and proxies may reuse course intelligence
+
+# Chapter mastery from the running quiz average: minimum average and level, highest first; below all is novice
+QUIZ_MASTERY_LEVELS = ((90, 'expert'), (80, 'proficient'), (70, 'developing'))
+
+# timeago thresholds below one day, largest first
+TIMEAGO_UNITS = ((3600, 'hour'), (60, 'minute'))
+
+
+class UploadRequest(Request):
+    """
+    Request that spools large uploaded files straight into the upload folder, so a saved
+    upload can be renamed into place instead of copied out of a temporary spool.
+    """
+    SPOOL_THRESHOLD = 500 * 1024  # smaller files stay in memory, as with the werkzeug default
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= self.SPOOL_THRESHOLD:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+        part_file = tempfile.NamedTemporaryFile(
+            'wb+', dir=current_app.config['UPLOAD_FOLDER'], prefix='.upload-', suffix='.part', delete=False
+        )
+        self.__dict__.setdefault('upload_part_paths', []).append(part_file.name)
+        return part_file
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """jsonify() through orjson, keeping Flask's output for dates, key order and pretty printing."""
+
+    def dumps(self, obj, **kwargs):
+        if kwargs.get('indent') is not None:  # debug responses are pretty-printed by the stdlib
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME  # dates go to self.default
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+        except TypeError:  # e.g. integers beyond 64 bits
+            return super().dumps(obj, **kwargs)
+
+
+def save_upload(file_storage, filepath: str) -> int:
+    """
+    Move an uploaded file to filepath, renaming its spool file when it already lives on disk.
+    Returns the file size in bytes.
+    """
+    stream = file_storage.stream
+    part_path = getattr(stream, 'name', None)
+    if part_path in getattr(request, 'upload_part_paths', ()):
+        stream.flush()
+        os.replace(part_path, filepath)
+    else:
+        file_storage.save(filepath)
+    stream.seek(0, os.SEEK_END)
+    return stream.tell()
+
 
 def create_app():
     """
     Adaptive factory function for creating multi-subject learning applications.
     """
     app = Flask(__name__)
+    app.request_class = UploadRequest
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
 
     # --- Configuration ---
     app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'adaptive-learning-secret-key')
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///adaptive_study_app.db'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_pre_ping': True,
+        'connect_args': {'check_same_thread': False, 'timeout': 30},
+    }
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 100MB for large PDFs
 
@@ -30,59 +136,264 @@ def create_app():
 
     with app.app_context():
         db.create_all()
+        ensure_schema()
+
+    # AI course research and PDF processing take seconds to minutes, so they run
+    # on a small background pool instead of holding the request thread.
+    background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ai-background')
+    # Job status lives in the upload_job table, so a poll answered by another worker process still finds it
+    UPLOAD_JOB_RETENTION = timedelta(hours=1)
+    # Activity rows that don't affect the response are written by their own single
+    # worker, so they never queue behind a long AI job.
+    activity_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='activity-log')
+
+    @app.teardown_request
+    def remove_unused_upload_parts(exc):
+        """Delete spooled upload files that a route did not move into place."""
+        for part_path in getattr(request, 'upload_part_paths', ()):
+            if os.path.exists(part_path):
+                os.remove(part_path)
 
     # --- Helper Functions ---
     def get_user_id():
         """Get or create session-based user ID."""
         if 'user_id' not in session:
-            import uuid
             session['user_id'] = str(uuid.uuid4())
         return session['user_id']
 
+    def _session_minutes_until(end: datetime):
+        """SQL for the whole minutes from StudySession.session_start to end, so every writer agrees."""
+        # Computed from milliseconds so float error can't drop a minute
+        return cast(cast(func.round(
+            (func.julianday(literal(end, DateTime)) - func.julianday(StudySession.session_start)) * 86400000
+        ), Integer) / 60000, Integer)
+
     def start_study_session(course_id=None, subject_id=None, chapter_id=None):
-        """Start a new study session for analytics."""
+        """Start a new study session for analytics; the calling route commits it."""
         user_id = get_user_id()
 
-        # End any existing active session
-        active_session = StudySession.query.filter_by(
-            user_id=user_id, session_end=None
-        ).first()
-
-        if active_session:
-            active_session.session_end = datetime.utcnow()
-            active_session.duration_minutes = int(
-                (active_session.session_end - active_session.session_start).total_seconds() / 60
-            )
+        # End any existing active session in one UPDATE (no SELECT round-trip)
+        now = datetime.utcnow()
+        db.session.execute(
+            update(StudySession)
+            .where(StudySession.user_id == user_id, StudySession.session_end.is_(None))
+            .values(session_end=now, duration_minutes=_session_minutes_until(now))
+        )
 
         # Start new session
         new_session = StudySession(
             user_id=user_id,
             course_id=course_id,
             subject_id=subject_id,
-            chapter_id=chapter_id,
-            activities=json.dumps([])
+            chapter_id=chapter_id
         )
         db.session.add(new_session)
-        db.session.commit()
+        db.session.flush()
 
         session['active_study_session'] = new_session.id
         return new_session.id
 
     def log_study_activity(activity_type: str, details: dict = None):
-        """Log an activity in the current study session."""
+        """Log an activity in the current study session; the calling route commits it."""
         if 'active_study_session' not in session:
             return
+        _record_study_activity(session['active_study_session'], activity_type, details)
 
-        study_session = StudySession.query.get(session['active_study_session'])
+    def log_study_activity_in_background(activity_type: str, details: dict = None):
+        """Log an activity in the current study session off the request thread, committing on its own."""
+        if 'active_study_session' not in session:
+            return
+        activity_executor.submit(
+            _record_study_activity_in_background,
+            session['active_study_session'], activity_type, details, datetime.utcnow()
+        )
+
+    def _record_study_activity_in_background(study_session_id: int, activity_type: str, details: dict,
+                                             timestamp: datetime):
+        """Write one activity row from the activity worker."""
+        with app.app_context():
+            try:
+                _record_study_activity(study_session_id, activity_type, details, timestamp)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Logging study activity failed: %s", e)
+            finally:
+                db.session.remove()
+
+    def _record_study_activity(study_session_id: int, activity_type: str, details: dict,
+                               timestamp: datetime = None):
+        """Stage an activity row and count it, if the study session is still open."""
+        study_session = db.session.get(StudySession, study_session_id)
         if study_session and not study_session.session_end:
-            activities = json.loads(study_session.activities or '[]')
-            activities.append({
-                'type': activity_type,
-                'timestamp': datetime.utcnow().isoformat(),
-                'details': details or {}
-            })
-            study_session.activities = json.dumps(activities)
-            db.session.commit()
+            db.session.add(StudyActivity(
+                session_id=study_session.id,
+                activity_type=activity_type,
+                timestamp=timestamp or datetime.utcnow(),
+                details=json_dumps(details or {})
+            ))
+            # Incremented in SQL so concurrent requests in the same session don't lose counts
+            study_session.activity_count = func.coalesce(StudySession.activity_count, 0) + 1
+
+    def _update_upload_job(job_id: str, **fields):
+        """Update the status record of a background upload job."""
+        db.session.execute(update(UploadJob).where(UploadJob.id == job_id).values(**fields))
+        db.session.commit()
+
+    def _is_reusable_course_context(enhanced_context: dict) -> bool:
+        """Only AI-researched context is worth persisting; the fallback should be retried later."""
+        return bool(enhanced_context) and not enhanced_context.get("web_intelligence", {}).get("fallback")
+
+    def _enhance_course_in_background(course_id: int, course_name: str, institution: str, student_input: dict):
+        """Gather AI course context and refine the course's estimated study hours."""
+        with app.app_context():
+            try:
+                enhanced_context = ai_service.enhance_course_with_web_intelligence(
+                    course_name, institution, student_input
+                )
+
+                # Extract domain information
+                synthesis = enhanced_context.get("synthesis", {})
+                estimated_hours = synthesis.get("difficulty_level", "intermediate")
+                if "advanced" in str(estimated_hours).lower():
+                    estimated_hours = 120
+                elif "beginner" in str(estimated_hours).lower():
+                    estimated_hours = 60
+                else:
+                    estimated_hours = 90
+
+                course = db.session.get(Course, course_id)
+                if course:
+                    course.estimated_study_hours = estimated_hours
+                    if _is_reusable_course_context(enhanced_context):
+                        course.enhanced_context = json_dumps(enhanced_context)
+                    db.session.commit()
+
+            except Exception as e:
+                db.session.rollback()
+                logger.exception("Course intelligence gathering failed: %s", e)
+            finally:
+                db.session.remove()
+
+    def _process_upload_in_background(job_id: str, course_id: int, filepath: str, filename: str,
+                                      file_size_bytes: int, subject_name: str, course_description: str,
+                                      existing_books: list, student_input: dict):
+        """Run AI PDF processing and store the resulting subject and chapters."""
+        with app.app_context():
+            try:
+                _update_upload_job(job_id, state='processing')
+                start_time = datetime.utcnow()
+
+                course = db.session.get(Course, course_id)
+                stored_context = (
+                    json_loads(course.enhanced_context) if course and course.enhanced_context else None
+                )
+
+                # Enhanced processing with course intelligence
+                try:
+                    if stored_context:
+                        # Course context was already researched for this course; reuse it
+                        processed_data = ai_service.process_pdf_with_course_intelligence(
+                            filepath, subject_name, stored_context
+                        )
+                    else:
+                        # Gather course context while the PDF uploads, then process with full course intelligence
+                        processed_data = ai_service.process_pdf_with_web_intelligence(
+                            filepath, subject_name, student_input['course_name'], student_input['university'],
+                            student_input
+                        )
+
+                except Exception as e:
+                    logger.warning("Enhanced processing failed, falling back to basic: %s", e)
+                    # Fallback to basic processing
+                    try:
+                        processed_data = ai_service.process_pdf_and_extract_chapters(
+                            filepath, subject_name, course_description, existing_books
+                        )
+                    except Exception as basic_error:
+                        _update_upload_job(job_id, state='failed', error=f"AI processing failed: {basic_error}")
+                        return
+
+                processing_time = int((datetime.utcnow() - start_time).total_seconds())
+
+                if 'error' in processed_data:
+                    _update_upload_job(job_id, state='failed',
+                                       error=f"AI processing failed: {processed_data['error']}")
+                    return
+
+                try:
+                    # Extract subject analysis and metadata
+                    subject_analysis = processed_data.get('subject_analysis', {})
+
+                    # Create the new subject with adaptive metadata
+                    new_subject = Subject(
+                        name=processed_data.get('subject_name', subject_name),
+                        preface=json_dumps(processed_data.get('preface', {})),
+                        overall_summary=json_dumps(processed_data.get('overall_summary', {})),
+                        subject_domain=subject_analysis.get('subject_domain', 'general'),
+                        learning_style=subject_analysis.get('learning_style', 'mixed'),
+                        complexity_level=subject_analysis.get('complexity_level', 'intermediate'),
+                        subject_analysis=json_dumps(subject_analysis),
+                        original_filename=filename,
+                        file_size_mb=round(file_size_bytes / (1024 * 1024), 2),
+                        processing_time_seconds=processing_time,
+                        course_id=course_id
+                    )
+                    db.session.add(new_subject)
+                    db.session.flush()  # assigns new_subject.id for the chapter rows
+
+                    # Add chapters with enhanced metadata in a single bulk INSERT
+                    chapter_rows = []
+                    for i, ch_data in enumerate(processed_data.get('chapters', []), 1):
+                        chapter_metadata = ch_data.get('chapter_metadata', {})
+                        content_blocks = ch_data.get('content_blocks') or []
+
+                        chapter_rows.append(dict(
+                            title=ch_data.get('title'),
+                            chapter_number=i,
+                            intro_summary=json_dumps(ch_data.get('intro_summary', {})),
+                            content_blocks=content_blocks,
+                            # Counted before the INSERT so nothing has to reload and decompress the blocks
+                            **content_block_counts(content_blocks),
+                            chapter_metadata=json_dumps(chapter_metadata),
+                            difficulty_level=chapter_metadata.get('difficulty_level', 'intermediate'),
+                            estimated_study_time=chapter_metadata.get('estimated_study_time', 30),
+                            subject_id=new_subject.id
+                        ))
+                    if chapter_rows:
+                        db.session.execute(insert(Chapter), chapter_rows)
+
+                    course_context = processed_data.get('course_intelligence')
+                    if course and not stored_context and _is_reusable_course_context(course_context):
+                        course.enhanced_context = json_dumps(course_context)
+
+                    db.session.commit()
+
+                    # Update statistics (chapter counters were written with the rows)
+                    update_subject_stats(new_subject.id)
+
+                    _update_upload_job(
+                        job_id, state='completed', subject_id=new_subject.id,
+                        subject_domain=subject_analysis.get('subject_domain', 'general')
+                    )
+
+                except Exception as e:
+                    db.session.rollback()
+                    _update_upload_job(job_id, state='failed',
+                                       error=f"Database error: Failed to save subject. Reason: {e}")
+
+            except Exception as e:
+                # Anything else (e.g. a locked database) must still end the job, or its page polls forever
+                logger.exception("Upload job %s failed: %s", job_id, e)
+                db.session.rollback()
+                _update_upload_job(job_id, state='failed', error=f"Upload processing failed: {e}")
+            finally:
+                db.session.remove()
+                # The subject keeps everything it needs; the PDF copy is only read while processing
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
 
     # =========================================================================
     # --- Course Management Routes ---
@@ -94,7 +405,8 @@ def create_app():
         user_id = get_user_id()
 
         # Get user's enrolled courses
-        enrollments = CourseEnrollment.query.filter_by(user_id=user_id).all()
+        enrollments = CourseEnrollment.query.options(selectinload(CourseEnrollment.course)) \
+            .filter_by(user_id=user_id).all()
         enrolled_courses = [enrollment.course for enrollment in enrollments]
 
         # Get all available courses
@@ -106,12 +418,11 @@ def create_app():
 
         # Get recommendations if user has courses
         recommendations = {}
-        if enrolled_courses:
+        if enrollments:
             # Get recommendations for the most recently active course
-            latest_course = max(enrolled_courses, key=lambda c: max(
-                e.last_activity for e in c.enrollments if e.user_id == user_id
-            ))
-            recommendations = get_adaptive_recommendations(user_id, latest_course.id)
+            # (one enrollment per user/course, so its last_activity is the course's)
+            latest_enrollment = max(enrollments, key=lambda e: e.last_activity)
+            recommendations = get_cached_adaptive_recommendations(user_id, latest_enrollment.course_id)
 
         return render_template('index.html',
                                enrolled_courses=enrolled_courses,
@@ -136,12 +447,6 @@ def create_app():
                 flash('Course name is required.', 'danger')
                 return redirect(request.url)
 
-            # Check if course already exists
-            existing = Course.query.filter_by(name=course_name).first()
-            if existing:
-                flash('A course with this name already exists.', 'warning')
-                return redirect(request.url)
-
             # Gather enhanced course intelligence
             student_input = {
                 "course_name": course_name,
@@ -152,50 +457,39 @@ def create_app():
                 "academic_level": academic_level
             }
 
-            # Get AI-enhanced course context
-            try:
-                enhanced_context = ai_service.enhance_course_with_web_intelligence(
-                    course_name, institution, student_input
-                )
-                course_intelligence = json.dumps(enhanced_context)
-
-                # Extract domain information
-                synthesis = enhanced_context.get("synthesis", {})
-                estimated_hours = synthesis.get("difficulty_level", "intermediate")
-                if "advanced" in str(estimated_hours).lower():
-                    estimated_hours = 120
-                elif "beginner" in str(estimated_hours).lower():
-                    estimated_hours = 60
-                else:
-                    estimated_hours = 90
-
-            except Exception as e:
-                print(f"Course intelligence gathering failed: {e}")
-                course_intelligence = json.dumps({"error": str(e), "fallback": True})
-                estimated_hours = 80
-
             # Create course with enhanced metadata
             new_course = Course(
                 name=course_name,
                 description=description,
                 academic_level=academic_level,
                 institution=institution,
-                estimated_study_hours=estimated_hours
+                estimated_study_hours=80  # refined once the AI course context is gathered
             )
 
-            db.session.add(new_course)
-            db.session.commit()
+            # The unique index on Course.name rejects duplicates, so no pre-check SELECT is needed
+            try:
+                db.session.add(new_course)
+                db.session.flush()
+
+                # Create enrollment for the creator
+                enrollment = CourseEnrollment(
+                    user_id=get_user_id(),
+                    course_id=new_course.id,
+                    preferred_difficulty=academic_level
+                )
+                db.session.add(enrollment)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                flash('A course with this name already exists.', 'warning')
+                return redirect(request.url)
 
-            # Create enrollment for the creator
-            enrollment = CourseEnrollment(
-                user_id=get_user_id(),
-                course_id=new_course.id,
-                preferred_difficulty=academic_level
+            # Get AI-enhanced course context off the request thread
+            background_executor.submit(
+                _enhance_course_in_background, new_course.id, course_name, institution, student_input
             )
-            db.session.add(enrollment)
-            db.session.commit()
 
-            flash(f'Course "{course_name}" created successfully with AI-enhanced context!', 'success')
+            flash(f'Course "{course_name}" created successfully! AI course context is being gathered.', 'success')
             return redirect(url_for('view_course', course_id=new_course.id))
 
         return render_template('create_course.html')
@@ -214,35 +508,40 @@ def create_app():
         if not enrollment:
             enrollment = CourseEnrollment(user_id=user_id, course_id=course_id)
             db.session.add(enrollment)
-            db.session.commit()
 
-        # Update last activity
+        # Update last activity (committed with the study session started below)
         enrollment.last_activity = datetime.utcnow()
-        db.session.commit()
 
-        # Get subjects with progress info
-        subjects_with_progress = []
-        for subject in course.subjects:
-            progress = UserProgress.query.filter_by(
-                user_id=user_id, subject_id=subject.id, chapter_id=None
-            ).first()
-
-            chapter_progress = UserProgress.query.filter_by(
-                user_id=user_id, subject_id=subject.id
-            ).filter(UserProgress.chapter_id.isnot(None)).all()
+        # Get subjects with progress info (one progress query for all subjects)
+        subjects = course.subjects
+        overall_progress = {}
+        chapter_progress = defaultdict(dict)
+        if subjects:
+            progress_rows = UserProgress.query.filter(
+                UserProgress.user_id == user_id,
+                UserProgress.subject_id.in_([subject.id for subject in subjects])
+            ).all()
+            for progress in progress_rows:
+                if progress.chapter_id is None:
+                    overall_progress.setdefault(progress.subject_id, progress)
+                else:
+                    chapter_progress[progress.subject_id][progress.chapter_id] = progress
 
+        subjects_with_progress = []
+        for subject in subjects:
             subjects_with_progress.append({
                 'subject': subject,
-                'overall_progress': progress,
-                'chapter_progress': {cp.chapter_id: cp for cp in chapter_progress}
+                'overall_progress': overall_progress.get(subject.id),
+                'chapter_progress': chapter_progress.get(subject.id, {})
             })
 
         # Get course progress summary
         progress_summary = get_user_course_progress(user_id, course_id)
-        recommendations = get_adaptive_recommendations(user_id, course_id)
+        recommendations = get_cached_adaptive_recommendations(user_id, course_id)
 
         # Start study session for this course
         start_study_session(course_id=course_id)
+        db.session.commit()
 
         return render_template('course.html',
                                course=course,
@@ -253,9 +552,7 @@ def create_app():
     @app.route('/course/<int:course_id>/subject/<int:subject_id>')
     def view_subject(course_id, subject_id):
         """View subject with adaptive content and progress tracking."""
-        subject = db.get_or_404(Subject, subject_id)
-        if subject.course_id != course_id:
-            abort(404)
+        subject = Subject.query.filter_by(id=subject_id, course_id=course_id).first_or_404()
 
         user_id = get_user_id()
 
@@ -265,35 +562,34 @@ def create_app():
             user_id=user_id, subject_id=subject_id
         ).all()
 
+        subject_progress = None
         for progress in progress_entries:
             if progress.chapter_id:
                 chapter_progress[progress.chapter_id] = progress
+            elif subject_progress is None:
+                subject_progress = progress
 
         # Update subject-level progress
-        subject_progress = UserProgress.query.filter_by(
-            user_id=user_id, subject_id=subject_id, chapter_id=None
-        ).first()
-
         if not subject_progress:
             subject_progress = UserProgress(
                 user_id=user_id,
                 subject_id=subject_id,
                 status='in_progress'
             )
-            db.session.add(subject_progress)
-            db.session.commit()
+            db.session.add(subject_progress)  # committed with the study session started below
 
         # Parse subject analysis for adaptive features
         subject_analysis = {}
         if subject.subject_analysis:
             try:
-                subject_analysis = json.loads(subject.subject_analysis)
+                subject_analysis = json_loads(subject.subject_analysis)
             except json.JSONDecodeError:
                 pass
 
         # Start study session for this subject
         start_study_session(course_id=course_id, subject_id=subject_id)
         log_study_activity('subject_access', {'subject_name': subject.name})
+        db.session.commit()
 
         return render_template('subject.html',
                                course=subject.course,
@@ -304,9 +600,12 @@ def create_app():
     @app.route('/course/<int:course_id>/subject/<int:subject_id>/chapter/<int:chapter_id>')
     def view_chapter(course_id, subject_id, chapter_id):
         """Enhanced chapter view with domain-adaptive content."""
-        chapter = db.get_or_404(Chapter, chapter_id)
-        if chapter.subject_id != subject_id or chapter.subject.course_id != course_id:
-            abort(404)
+        # One JOIN checks the URL's subject/course ownership and populates chapter.subject
+        chapter = Chapter.query.join(Chapter.subject).filter(
+            Chapter.id == chapter_id,
+            Subject.id == subject_id,
+            Subject.course_id == course_id
+        ).options(contains_eager(Chapter.subject), defer(Chapter.content_blocks)).first_or_404()
 
         user_id = get_user_id()
 
@@ -316,53 +615,62 @@ def create_app():
             session.pop('last_answer', None)
         session['qna_chapter_id'] = chapter_id
 
-        # Parse content blocks
-        content_blocks = []
-        if chapter.content_blocks:
-            try:
-                content_blocks = json.loads(chapter.content_blocks)
-            except json.JSONDecodeError:
-                flash('Error decoding chapter content.', 'danger')
-
-        # Get user bookmarks for this chapter
-        user_bookmarks = Bookmark.query.filter_by(
-            user_id=user_id, chapter_id=chapter_id
-        ).all()
-        bookmark_indices = {bookmark.content_block_index for bookmark in user_bookmarks}
-
-        # Update chapter progress
-        chapter_progress = UserProgress.query.filter_by(
-            user_id=user_id, subject_id=subject_id, chapter_id=chapter_id
-        ).first()
-
-        if not chapter_progress:
-            chapter_progress = UserProgress(
-                user_id=user_id,
-                subject_id=subject_id,
-                chapter_id=chapter_id,
-                status='in_progress'
+        # Get bookmarked block indices for this chapter (column only, no Bookmark objects)
+        bookmark_indices = set(db.session.scalars(
+            select(Bookmark.content_block_index).where(
+                Bookmark.user_id == user_id, Bookmark.chapter_id == chapter_id
             )
-            db.session.add(chapter_progress)
-        else:
-            chapter_progress.last_accessed = datetime.utcnow()
-            chapter_progress.sessions_count += 1
+        ))
 
-        db.session.commit()
+        # Everything the rendered page depends on, so a refresh can be answered with 304
+        etag = hashlib.sha1(json_dumps([
+            chapter.id, str(chapter.updated_at), str(chapter.subject.updated_at), course_id,
+            sorted(index for index in bookmark_indices if index is not None),
+            session.get('last_question'), session.get('last_answer')
+        ]).encode('utf-8')).hexdigest()
 
-        # Start study session for this chapter
+        # Update chapter progress with one upsert on the unique (user, subject, chapter) index
+        now = datetime.utcnow()
+        upsert = sqlite_insert(UserProgress).values(
+            user_id=user_id,
+            subject_id=subject_id,
+            chapter_id=chapter_id,
+            status='in_progress',
+            last_accessed=now
+        ).on_conflict_do_update(
+            index_elements=['user_id', 'subject_id', 'chapter_id'],
+            set_={'last_accessed': now, 'sessions_count': UserProgress.sessions_count + 1}
+        )
+        chapter_progress = db.session.scalars(
+            upsert.returning(UserProgress), execution_options={'populate_existing': True}
+        ).one()
+
+        # Start study session for this chapter; one commit covers it and the progress update above
         start_study_session(course_id=course_id, subject_id=subject_id, chapter_id=chapter_id)
         log_study_activity('chapter_access', {
             'chapter_title': chapter.title,
             'subject_domain': chapter.subject.subject_domain
         })
+        db.session.commit()
 
-        return render_template('chapter.html',
-                               course_id=course_id,
-                               subject=chapter.subject,
-                               chapter=chapter,
-                               content_blocks=content_blocks,
-                               bookmark_indices=bookmark_indices,
-                               chapter_progress=chapter_progress)
+        # Pending flash messages are part of the page, so only answer 304 without them
+        if '_flashes' not in session and request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            # Content blocks are decoded by the CompressedJSON column type, only when rendering
+            content_blocks = chapter.content_blocks or []
+
+            response = make_response(render_template('chapter.html',
+                                                     course_id=course_id,
+                                                     subject=chapter.subject,
+                                                     chapter=chapter,
+                                                     content_blocks=content_blocks,
+                                                     bookmark_indices=bookmark_indices,
+                                                     chapter_progress=chapter_progress))
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True  # always revalidate, so the visit is still recorded
+        return response
 
     # =========================================================================
     # --- PDF Upload and Processing Routes ---
@@ -384,8 +692,11 @@ def create_app():
 
             if pdf_file and pdf_file.filename.endswith('.pdf'):
                 filename = secure_filename(pdf_file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                pdf_file.save(filepath)
+                job_id = uuid.uuid4().hex
+                # Saved under the job id: a later upload with the same name must not replace
+                # the file while this job is still processing it
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{job_id}-{filename}")
+                file_size_bytes = save_upload(pdf_file, filepath)
 
                 # Get existing books in course for context
                 existing_subjects = Subject.query.filter_by(course_id=course_id).all()
@@ -394,106 +705,55 @@ def create_app():
                     for s in existing_subjects
                 ]
 
-                flash(f'File "{filename}" uploaded. Processing with adaptive AI... This may take a moment.', 'info')
-
-                start_time = datetime.utcnow()
-
-                # Enhanced processing with course intelligence
-                try:
-                    # Get course intelligence for context
-                    user_id = get_user_id()
-                    enrollment = CourseEnrollment.query.filter_by(
-                        user_id=user_id, course_id=course_id
-                    ).first()
-
-                    student_input = {
-                        "course_name": course.name,
-                        "university": course.institution or "",
-                        "academic_level": course.academic_level,
-                        "career_goals": [],  # Could be enhanced from user profile
-                        "learning_objectives": []
-                    }
-
-                    # Get enhanced course context
-                    enhanced_context = ai_service.enhance_course_with_web_intelligence(
-                        course.name, course.institution or "", student_input
-                    )
-
-                    # Process PDF with full course intelligence
-                    processed_data = ai_service.process_pdf_with_course_intelligence(
-                        filepath, subject_name, enhanced_context
-                    )
-
-                except Exception as e:
-                    print(f"Enhanced processing failed, falling back to basic: {e}")
-                    # Fallback to basic processing
-                    processed_data = ai_service.process_pdf_and_extract_chapters(
-                        filepath, subject_name, course_description, existing_books
-                    )
-
-                processing_time = int((datetime.utcnow() - start_time).total_seconds())
-
-                if 'error' in processed_data:
-                    flash(f"AI processing failed: {processed_data['error']}", 'danger')
-                    return redirect(request.url)
-
-                try:
-                    # Extract subject analysis and metadata
-                    subject_analysis = processed_data.get('subject_analysis', {})
-                    course_intelligence = processed_data.get('course_intelligence', {})
-                    processing_metadata = processed_data.get('processing_metadata', {})
-
-                    # Create the new subject with adaptive metadata
-                    new_subject = Subject(
-                        name=processed_data.get('subject_name', subject_name),
-                        preface=json.dumps(processed_data.get('preface', {})),
-                        overall_summary=json.dumps(processed_data.get('overall_summary', {})),
-                        subject_domain=subject_analysis.get('subject_domain', 'general'),
-                        learning_style=subject_analysis.get('learning_style', 'mixed'),
-                        complexity_level=subject_analysis.get('complexity_level', 'intermediate'),
-                        subject_analysis=json.dumps(subject_analysis),
-                        original_filename=filename,
-                        file_size_mb=round(os.path.getsize(filepath) / (1024 * 1024), 2),
-                        processing_time_seconds=processing_time,
-                        course_id=course_id
-                    )
-                    db.session.add(new_subject)
-
-                    # Add chapters with enhanced metadata
-                    for i, ch_data in enumerate(processed_data.get('chapters', []), 1):
-                        chapter_metadata = ch_data.get('chapter_metadata', {})
-
-                        new_chapter = Chapter(
-                            title=ch_data.get('title'),
-                            chapter_number=i,
-                            intro_summary=json.dumps(ch_data.get('intro_summary', {})),
-                            content_blocks=json.dumps(ch_data.get('content_blocks', [])),
-                            chapter_metadata=json.dumps(chapter_metadata),
-                            difficulty_level=chapter_metadata.get('difficulty_level', 'intermediate'),
-                            estimated_study_time=chapter_metadata.get('estimated_study_time', 30),
-                            subject=new_subject
-                        )
-                        db.session.add(new_chapter)
-
-                    db.session.commit()
-
-                    # Update statistics
-                    update_subject_stats(new_subject.id)
-                    for chapter in new_subject.chapters:
-                        update_chapter_stats(chapter.id)
+                student_input = {
+                    "course_name": course.name,
+                    "university": course.institution or "",
+                    "academic_level": course.academic_level,
+                    "career_goals": [],  # Could be enhanced from user profile
+                    "learning_objectives": []
+                }
 
-                    domain_display = subject_analysis.get('subject_domain', 'general').replace('_', ' ').title()
-                    flash(f'Successfully processed "{filename}" as {domain_display} content!', 'success')
-                    return redirect(url_for('view_subject', course_id=course_id, subject_id=new_subject.id))
+                now = datetime.utcnow()
+                # Forget finished jobs nobody has polled for a while
+                UploadJob.query.filter(
+                    UploadJob.state.in_(('completed', 'failed')),
+                    UploadJob.created_at < now - UPLOAD_JOB_RETENTION
+                ).delete(synchronize_session=False)
+                db.session.add(UploadJob(id=job_id, course_id=course_id, filename=filename,
+                                         state='queued', created_at=now))
+                db.session.commit()  # the worker reads the job from its own session
+
+                background_executor.submit(
+                    _process_upload_in_background, job_id, course_id, filepath, filename, file_size_bytes,
+                    subject_name, course_description, existing_books, student_input
+                )
 
-                except Exception as e:
-                    db.session.rollback()
-                    flash(f"Database error: Failed to save subject. Reason: {e}", 'danger')
+                flash(f'File "{filename}" uploaded. Processing with adaptive AI in the background... '
+                      f'The subject will appear in this course when it is ready.', 'info')
+                return redirect(url_for('view_course', course_id=course_id, upload_job=job_id))
             else:
                 flash('Please upload a PDF file.', 'danger')
 
         return render_template('upload_pdf.html', course=course)
 
+    @app.route('/api/upload-status/<job_id>')
+    def get_upload_status(job_id):
+        """Report the state of a background PDF processing job."""
+        job = db.get_or_404(UploadJob, job_id)
+
+        status = {
+            'job_id': job_id,
+            'state': job.state,
+            'filename': job.filename,
+            'error': job.error
+        }
+        if job.state == 'completed':
+            domain_display = (job.subject_domain or 'general').replace('_', ' ').title()
+            status['message'] = f'Successfully processed "{job.filename}" as {domain_display} content!'
+            status['redirect_url'] = url_for('view_subject', course_id=job.course_id,
+                                             subject_id=job.subject_id)
+        return jsonify(status)
+
     # =========================================================================
     # --- Adaptive Content Routes ---
     # =========================================================================
@@ -519,6 +779,7 @@ def create_app():
             'difficulty_level': difficulty_level,
             'subject_domain': subject_domain
         })
+        db.session.commit()
 
         return jsonify({'simplified_text': simplified})
 
@@ -541,6 +802,7 @@ def create_app():
             'subject_domain': subject_domain,
             'visualization_type': visualization_data.get('visualization_type')
         })
+        db.session.commit()
 
         return jsonify(visualization_data)
 
@@ -575,12 +837,12 @@ def create_app():
             ).first()
             if progress:
                 progress.questions_asked += 1
-                db.session.commit()
 
             log_study_activity('question_asked', {
                 'subject_domain': subject_domain,
                 'question_length': len(question)
             })
+            db.session.commit()
 
         return redirect(url_for(
             'view_chapter',
@@ -607,8 +869,10 @@ def create_app():
         difficulty = user_progress.difficulty_preference if user_progress else 'intermediate'
         subject_domain = chapter.subject.subject_domain
 
+        # ?fresh=1 asks for a new quiz instead of the cached one
         quiz_data = ai_service.generate_quiz_from_summary(
-            chapter.intro_summary, subject_domain, difficulty
+            chapter.intro_summary, subject_domain, difficulty,
+            bypass_cache=request.args.get('fresh') == '1'
         )
 
         if not quiz_data or 'error' in quiz_data:
@@ -625,6 +889,7 @@ def create_app():
             'difficulty': difficulty,
             'question_count': len(quiz_data.get('questions', []))
         })
+        db.session.commit()
 
         return render_template('quiz.html',
                                chapter=chapter,
@@ -639,7 +904,7 @@ def create_app():
 
         try:
             quiz_data_json = request.form.get('quiz_data')
-            quiz_data = json.loads(quiz_data_json)
+            quiz_data = json_loads(quiz_data_json)
             questions = quiz_data.get('questions', [])
             quiz_start_time = request.form.get('start_time')
 
@@ -649,29 +914,31 @@ def create_app():
             concept_performance = {}
 
             # Analyze performance by question type and concept
+            form = request.form
             for i, question in enumerate(questions):
-                user_answer = request.form.get(f'question_{i}')
+                user_answer = form.get(f'question_{i}')
+                if user_answer is not None:
+                    user_answer = int(user_answer)
                 correct_answer = question.get('correct_answer_index')
-                is_correct = user_answer is not None and int(user_answer) == correct_answer
+                is_correct = user_answer is not None and user_answer == correct_answer
+                concept = question.get('concept_tested', 'general')
 
                 user_answers[i] = {
-                    'user_answer': int(user_answer) if user_answer is not None else None,
+                    'user_answer': user_answer,
                     'correct_answer': correct_answer,
                     'is_correct': is_correct,
                     'question_type': question.get('question_type', 'multiple_choice'),
-                    'concept_tested': question.get('concept_tested', 'general')
+                    'concept_tested': concept
                 }
 
-                if is_correct:
-                    score += 1
-
                 # Track concept mastery
-                concept = question.get('concept_tested', 'general')
-                if concept not in concept_performance:
-                    concept_performance[concept] = {'correct': 0, 'total': 0}
-                concept_performance[concept]['total'] += 1
+                perf = concept_performance.get(concept)
+                if perf is None:
+                    perf = concept_performance[concept] = {'correct': 0, 'total': 0}
+                perf['total'] += 1
                 if is_correct:
-                    concept_performance[concept]['correct'] += 1
+                    score += 1
+                    perf['correct'] += 1
 
             percentage = (score / total * 100) if total > 0 else 0
 
@@ -702,47 +969,47 @@ def create_app():
                 percentage=percentage,
                 difficulty_level=quiz_data.get('difficulty', 'intermediate'),
                 time_taken_seconds=time_taken,
-                concept_mastery=json.dumps(concept_performance),
-                areas_for_improvement=json.dumps(weak_concepts),
-                questions_and_answers=json.dumps({
+                concept_mastery=json_dumps(concept_performance),
+                areas_for_improvement=json_dumps(weak_concepts),
+                questions_and_answers=json_dumps({
                     'questions': questions,
                     'user_answers': user_answers
                 })
             )
             db.session.add(quiz_result)
 
-            # Update user progress with detailed analytics
-            progress = UserProgress.query.filter_by(
-                user_id=user_id, chapter_id=chapter_id
-            ).first()
+            # Update user progress with detailed analytics: exact running mean over quizzes_taken,
+            # and mastery from that new mean, in one UPDATE (SET expressions all see the old row)
+            quizzes_taken = func.coalesce(UserProgress.quizzes_taken, 0)
+            new_avg = (func.coalesce(UserProgress.avg_quiz_score, 0) * quizzes_taken + percentage) / (quizzes_taken + 1)
+            db.session.execute(
+                update(UserProgress)
+                .where(UserProgress.user_id == user_id, UserProgress.chapter_id == chapter_id)
+                .values(
+                    quizzes_taken=quizzes_taken + 1,
+                    avg_quiz_score=new_avg,
+                    mastery_level=case(
+                        *((new_avg >= threshold, level) for threshold, level in QUIZ_MASTERY_LEVELS),
+                        else_='novice'
+                    )
+                ),
+                execution_options={'synchronize_session': False}
+            )
 
-            if progress:
-                progress.quizzes_taken += 1
-                # Update average quiz score
-                if progress.avg_quiz_score == 0:
-                    progress.avg_quiz_score = percentage
-                else:
-                    progress.avg_quiz_score = (progress.avg_quiz_score + percentage) / 2
-
-                # Update struggle areas
-                if weak_concepts:
-                    existing_struggles = json.loads(progress.struggle_areas or '[]')
-                    updated_struggles = list(set(existing_struggles + weak_concepts))
-                    progress.struggle_areas = json.dumps(updated_struggles)
-
-                # Update mastery level based on consistent performance
-                if progress.avg_quiz_score >= 90:
-                    progress.mastery_level = 'expert'
-                elif progress.avg_quiz_score >= 80:
-                    progress.mastery_level = 'proficient'
-                elif progress.avg_quiz_score >= 70:
-                    progress.mastery_level = 'developing'
-                else:
-                    progress.mastery_level = 'novice'
+            # Record struggle areas; concepts already recorded for this chapter are skipped by the unique index
+            if weak_concepts:
+                db.session.execute(
+                    sqlite_insert(StruggleArea).values([
+                        {'user_id': user_id, 'chapter_id': chapter_id, 'concept': concept}
+                        for concept in weak_concepts
+                    ]).on_conflict_do_nothing(index_elements=['user_id', 'chapter_id', 'concept'])
+                )
 
-                db.session.commit()
+            db.session.commit()
 
-            log_study_activity('quiz_completed', {
+            invalidate_adaptive_recommendations(user_id, chapter.subject.course_id)
+
+            log_study_activity_in_background('quiz_completed', {
                 'subject_domain': chapter.subject.subject_domain,
                 'score': score,
                 'total': total,
@@ -824,12 +1091,11 @@ def create_app():
         if progress:
             progress.concepts_bookmarked += 1
 
-        db.session.commit()
-
         log_study_activity('bookmark_created', {
             'content_type': content_block_type,
             'reason': reason
         })
+        db.session.commit()
 
         return jsonify({
             'message': 'Bookmark added successfully',
@@ -855,33 +1121,33 @@ def create_app():
         """Enhanced bookmark management with filtering and organization."""
         user_id = get_user_id()
 
-        # Get bookmarks with related data
+        # Get bookmarks with related data, populating chapter/subject/course from the same JOIN;
+        # the free-text note and tags columns are left out of the list query
         bookmarks = db.session.query(Bookmark) \
-            .join(Chapter) \
-            .join(Subject) \
-            .join(Course) \
+            .join(Bookmark.chapter) \
+            .join(Chapter.subject) \
+            .join(Subject.course) \
+            .options(
+                defer(Bookmark.note),
+                defer(Bookmark.tags),
+                contains_eager(Bookmark.chapter).defer(Chapter.content_blocks),
+                contains_eager(Bookmark.chapter).contains_eager(Chapter.subject).contains_eager(Subject.course)
+            ) \
             .filter(Bookmark.user_id == user_id) \
-            .order_by(Bookmark.created_at.desc()) \
+            .order_by(Course.name, Subject.name, Bookmark.created_at.desc()) \
             .all()
 
-        # Group bookmarks by course and subject
+        # Group bookmarks by course and subject; rows arrive sorted by both, so each group is one run
         organized_bookmarks = {}
-        for bookmark in bookmarks:
-            course_name = bookmark.chapter.subject.course.name
-            subject_name = bookmark.chapter.subject.name
-            subject_domain = bookmark.chapter.subject.subject_domain
-
-            if course_name not in organized_bookmarks:
-                organized_bookmarks[course_name] = {}
-
-            if subject_name not in organized_bookmarks[course_name]:
-                organized_bookmarks[course_name][subject_name] = {
-                    'domain': subject_domain,
-                    'bookmarks': []
+        for course_name, course_bookmarks in groupby(bookmarks, key=lambda b: b.chapter.subject.course.name):
+            organized_bookmarks[course_name] = subjects = {}
+            for subject_name, subject_bookmarks in groupby(course_bookmarks, key=lambda b: b.chapter.subject.name):
+                subject_bookmarks = list(subject_bookmarks)
+                subjects[subject_name] = {
+                    'domain': subject_bookmarks[0].chapter.subject.subject_domain,
+                    'bookmarks': subject_bookmarks
                 }
 
-            organized_bookmarks[course_name][subject_name]['bookmarks'].append(bookmark)
-
         return render_template('bookmarks.html',
                                organized_bookmarks=organized_bookmarks)
 
@@ -894,13 +1160,15 @@ def create_app():
         """Comprehensive learning analytics dashboard."""
         user_id = get_user_id()
 
-        # Get all user's enrollments and progress
-        enrollments = CourseEnrollment.query.filter_by(user_id=user_id).all()
+        # Get all user's enrollments and progress (courses and progress summaries fetched in bulk)
+        enrollments = CourseEnrollment.query.options(selectinload(CourseEnrollment.course)) \
+            .filter_by(user_id=user_id).all()
+        progress_by_course = get_user_course_progress_batch(user_id, enrollments)
 
         analytics_data = {}
         for enrollment in enrollments:
-            course_progress = get_user_course_progress(user_id, enrollment.course_id)
-            recommendations = get_adaptive_recommendations(user_id, enrollment.course_id)
+            course_progress = progress_by_course[enrollment.course_id]
+            recommendations = get_cached_adaptive_recommendations(user_id, enrollment.course_id)
 
             analytics_data[enrollment.course.name] = {
                 'course': enrollment.course,
@@ -908,29 +1176,35 @@ def create_app():
                 'recommendations': recommendations
             }
 
-        # Get recent study sessions
-        recent_sessions = StudySession.query.filter_by(user_id=user_id) \
-            .filter(StudySession.session_end.isnot(None)) \
-            .order_by(StudySession.session_start.desc()) \
-            .limit(10).all()
-
-        # Calculate learning velocity and patterns
-        total_study_time = sum(session.duration_minutes or 0 for session in recent_sessions)
-        avg_session_length = total_study_time / len(recent_sessions) if recent_sessions else 0
-
-        # Get subject domain performance
-        quiz_results = QuizResult.query.filter_by(user_id=user_id).all()
-        domain_performance = {}
-        for qr in quiz_results:
-            domain = qr.subject_domain or 'general'
-            if domain not in domain_performance:
-                domain_performance[domain] = {'scores': [], 'count': 0}
-            domain_performance[domain]['scores'].append(qr.percentage)
-            domain_performance[domain]['count'] += 1
-
-        # Calculate average performance by domain
-        for domain, data in domain_performance.items():
-            data['average'] = sum(data['scores']) / len(data['scores'])
+        # Get recent study sessions (only the columns shown, not full ORM objects)
+        recent_sessions_query = select(
+            StudySession.id,
+            StudySession.session_start,
+            StudySession.session_end,
+            StudySession.duration_minutes,
+            StudySession.engagement_score,
+        ).where(
+            StudySession.user_id == user_id,
+            StudySession.session_end.isnot(None),
+        ).order_by(StudySession.session_start.desc()).limit(10)
+        recent_sessions = db.session.execute(recent_sessions_query).all()
+
+        # Calculate learning velocity and patterns over the same ten sessions in SQL
+        recent = recent_sessions_query.subquery()
+        total_study_time, session_count = db.session.execute(select(
+            func.coalesce(func.sum(recent.c.duration_minutes), 0), func.count()
+        ).select_from(recent)).one()
+        avg_session_length = total_study_time / session_count if session_count else 0
+
+        # Get subject domain performance (averaged in SQL; a missing domain counts as general)
+        domain = func.coalesce(QuizResult.subject_domain, 'general')
+        domain_rows = db.session.query(
+            domain, func.count(QuizResult.id), func.avg(QuizResult.percentage)
+        ).filter(QuizResult.user_id == user_id).group_by(domain).all()
+        domain_performance = {
+            domain_name: {'count': count, 'average': average}
+            for domain_name, count, average in domain_rows
+        }
 
         return render_template('analytics.html',
                                analytics_data=analytics_data,
@@ -945,26 +1219,26 @@ def create_app():
         chapter = db.get_or_404(Chapter, chapter_id)
         user_id = get_user_id()
 
-        progress = UserProgress.query.filter_by(
-            user_id=user_id, chapter_id=chapter_id
-        ).first()
-
-        if not progress:
-            progress = UserProgress(
-                user_id=user_id,
-                subject_id=chapter.subject_id,
-                chapter_id=chapter_id,
-                status='completed',
-                completion_percentage=100.0,
-                completed_at=datetime.utcnow()
-            )
-            db.session.add(progress)
-        else:
-            progress.status = 'completed'
-            progress.completion_percentage = 100.0
-            progress.completed_at = datetime.utcnow()
-
+        # Insert or complete the progress row in one statement on the unique (user, subject, chapter) index
+        upsert = sqlite_insert(UserProgress).values(
+            user_id=user_id,
+            subject_id=chapter.subject_id,
+            chapter_id=chapter_id,
+            status='completed',
+            completion_percentage=100.0,
+            completed_at=datetime.utcnow()
+        )
+        upsert = upsert.on_conflict_do_update(
+            index_elements=['user_id', 'subject_id', 'chapter_id'],
+            set_={
+                'status': upsert.excluded.status,
+                'completion_percentage': upsert.excluded.completion_percentage,
+                'completed_at': upsert.excluded.completed_at
+            }
+        )
+        db.session.execute(upsert)
         db.session.commit()
+        invalidate_adaptive_recommendations(user_id, chapter.subject.course_id)
 
         flash(f'Chapter "{chapter.title}" marked as completed!', 'success')
         return redirect(url_for('view_chapter',
@@ -979,25 +1253,34 @@ def create_app():
     @app.route('/api/chapter/<int:chapter_id>/stats')
     def get_chapter_stats(chapter_id):
         """Get chapter statistics for analytics."""
-        chapter = db.get_or_404(Chapter, chapter_id)
+        # Read-only: plain rows with the Chapter.to_dict() fields, no content_blocks or ORM objects
+        chapter = db.session.execute(select(
+            Chapter.id, Chapter.title, Chapter.chapter_number, Chapter.difficulty_level,
+            Chapter.estimated_study_time, Chapter.total_content_blocks, Chapter.concept_count,
+            Chapter.visualization_count, Chapter.exercise_count, Chapter.case_study_count,
+            Chapter.subject_id,
+            case((Subject.id.is_(None), 'unknown'), else_=Subject.subject_domain).label('subject_domain')
+        ).outerjoin(Chapter.subject).where(Chapter.id == chapter_id)).first()
+        if chapter is None:
+            abort(404)
         user_id = get_user_id()
 
-        progress = UserProgress.query.filter_by(
-            user_id=user_id, chapter_id=chapter_id
-        ).first()
+        progress = db.session.execute(select(
+            UserProgress.status, UserProgress.time_spent_minutes, UserProgress.questions_asked
+        ).where(UserProgress.user_id == user_id, UserProgress.chapter_id == chapter_id).limit(1)).first()
 
-        quiz_results = QuizResult.query.filter_by(
-            user_id=user_id, chapter_id=chapter_id
-        ).all()
+        quizzes_taken, avg_quiz_score = db.session.query(
+            func.count(QuizResult.id), func.avg(QuizResult.percentage)
+        ).filter_by(user_id=user_id, chapter_id=chapter_id).one()
 
         return jsonify({
-            'chapter': chapter.to_dict(),
+            'chapter': chapter._asdict(),
             'progress': {
                 'status': progress.status if progress else 'not_started',
                 'time_spent': progress.time_spent_minutes if progress else 0,
                 'questions_asked': progress.questions_asked if progress else 0,
-                'quizzes_taken': len(quiz_results),
-                'avg_quiz_score': sum(qr.percentage for qr in quiz_results) / len(quiz_results) if quiz_results else 0
+                'quizzes_taken': quizzes_taken,
+                'avg_quiz_score': avg_quiz_score or 0
             }
         })
 
@@ -1005,28 +1288,45 @@ def create_app():
     def get_detailed_course_progress(course_id):
         """Get detailed progress analytics for a course."""
         user_id = get_user_id()
-        course = db.get_or_404(Course, course_id)
+        if db.session.scalar(select(Course.id).where(Course.id == course_id)) is None:
+            abort(404)
 
         # Get overall progress
         overall_progress = get_user_course_progress(user_id, course_id)
 
+        # Per-subject counts and averages for the whole course, one grouped query each
+        subjects = db.session.execute(
+            select(Subject.id, Subject.name, Subject.subject_domain)
+            .where(Subject.course_id == course_id).order_by(Subject.id)
+        ).all()
+        subject_ids = [subject.id for subject in subjects]
+        completed_by_subject, chapters_by_subject, quiz_avg_by_subject = {}, {}, {}
+        if subject_ids:
+            completed_by_subject = dict(db.session.query(UserProgress.subject_id, func.count()).filter(
+                UserProgress.user_id == user_id,
+                UserProgress.subject_id.in_(subject_ids),
+                UserProgress.status == 'completed',
+                UserProgress.chapter_id.isnot(None)
+            ).group_by(UserProgress.subject_id).all())
+
+            chapters_by_subject = dict(db.session.query(Chapter.subject_id, func.count()).filter(
+                Chapter.subject_id.in_(subject_ids)
+            ).group_by(Chapter.subject_id).all())
+
+            quiz_avg_by_subject = dict(db.session.query(Chapter.subject_id, func.avg(QuizResult.percentage))
+                                       .select_from(QuizResult).join(QuizResult.chapter).filter(
+                QuizResult.user_id == user_id,
+                Chapter.subject_id.in_(subject_ids)
+            ).group_by(Chapter.subject_id).all())
+
         # Get subject-level progress
         subject_progress = []
-        for subject in course.subjects:
-            progress_entries = UserProgress.query.filter_by(
-                user_id=user_id, subject_id=subject.id
-            ).all()
-
-            completed_chapters = len([p for p in progress_entries if p.status == 'completed' and p.chapter_id])
-            total_chapters = len(subject.chapters)
+        for subject in subjects:
+            completed_chapters = completed_by_subject.get(subject.id, 0)
+            total_chapters = chapters_by_subject.get(subject.id, 0)
             progress_pct = (completed_chapters / total_chapters * 100) if total_chapters > 0 else 0
 
-            quiz_results = QuizResult.query.join(Chapter).filter(
-                QuizResult.user_id == user_id,
-                Chapter.subject_id == subject.id
-            ).all()
-
-            avg_quiz = sum(qr.percentage for qr in quiz_results) / len(quiz_results) if quiz_results else 0
+            avg_quiz = quiz_avg_by_subject.get(subject.id) or 0
 
             # Determine mastery level
             mastery = 'novice'
@@ -1062,13 +1362,13 @@ def create_app():
         study_session = StudySession.query.get(session['active_study_session'])
         if study_session and not study_session.session_end:
             study_session.session_end = datetime.utcnow()
-            study_session.duration_minutes = int(
-                (study_session.session_end - study_session.session_start).total_seconds() / 60
-            )
+            study_session.duration_minutes = _session_minutes_until(study_session.session_end)
 
             # Calculate engagement metrics based on activities
-            activities = json.loads(study_session.activities or '[]')
-            study_session.engagement_score = min(100, len(activities) * 10)  # Simple metric
+            activity_count = study_session.activity_count or 0
+            if study_session.activities:  # sessions started before activities were stored as rows
+                activity_count += len(json_loads(study_session.activities))
+            study_session.engagement_score = min(100, activity_count * 10)  # Simple metric
 
             db.session.commit()
 
@@ -1079,13 +1379,15 @@ def create_app():
     def get_bookmark_count():
         """Get total bookmark count for user."""
         user_id = get_user_id()
-        count = Bookmark.query.filter_by(user_id=user_id).count()
+        # Counted fresh each time (answered from ix_bookmark_user_created) so cascaded deletes and
+        # concurrent add/remove calls are always reflected
+        count = db.session.scalar(select(func.count()).select_from(Bookmark).where(Bookmark.user_id == user_id))
         return jsonify({'count': count})
 
     @app.route('/api/ai-service/test')
     def test_ai_service():
         """Test AI service connection."""
-        result = ai_service.test_ai_service_connection()
+        result = ai_service.test_ai_service_connection(force_refresh=request.args.get('fresh') == '1')
         return jsonify(result)
 
     @app.route('/api/ai-service/stats')
@@ -1108,17 +1410,35 @@ def create_app():
             course_name, university, course_code
         )
 
-        return jsonify(intelligence)
+        response = jsonify(intelligence)
+        if 'error' in intelligence:
+            response.cache_control.no_store = True  # let the next request retry
+            return response
+
+        # Not user-specific and cached server-side for days, so shared caches may keep it for a day
+        response.cache_control.public = True
+        response.cache_control.max_age = COURSE_INTELLIGENCE_MAX_AGE
+        response.add_etag()
+        return response.make_conditional(request)
 
     @app.route('/health')
     def health_check():
         """Health check endpoint."""
+        try:
+            db.session.execute(db.text('SELECT 1'))
+            database_status = 'connected'
+        except Exception as e:
+            db.session.rollback()
+            print(f"Health check database ping failed: {e}")
+            database_status = 'error'
+
+        healthy = database_status == 'connected'
         return jsonify({
-            'status': 'healthy',
+            'status': 'healthy' if healthy else 'unhealthy',
             'timestamp': datetime.utcnow().isoformat(),
-            'database': 'connected',
+            'database': database_status,
             'ai_service': 'configured' if ai_service._is_api_configured() else 'not_configured'
-        })
+        }), 200 if healthy else 503
 
     # =========================================================================
     # --- Error Handlers ---
@@ -1173,13 +1493,24 @@ def create_app():
 
     @app.template_filter('from_json')
     def from_json_filter(json_str):
-        """Template filter to parse JSON strings."""
+        """Template filter to parse JSON strings, once per distinct value per request."""
         if not json_str:
             return {}
+        parsed_json = g.get('parsed_json')
+        if parsed_json is None:
+            parsed_json = g.parsed_json = {}
         try:
-            return json.loads(json_str)
-        except (json.JSONDecodeError, TypeError):
+            return parsed_json[json_str]
+        except KeyError:
+            pass
+        except TypeError:
             return {}
+        try:
+            value = json_loads(json_str)
+        except (json.JSONDecodeError, TypeError):
+            value = {}
+        parsed_json[json_str] = value
+        return value
 
     @app.template_filter('timeago')
     def timeago_filter(datetime_obj):
@@ -1187,19 +1518,22 @@ def create_app():
         if not datetime_obj:
             return 'Never'
 
-        now = datetime.utcnow()
+        # One clock read per request, shared by every row the template formats
+        now = g.get('timeago_now')
+        if now is None:
+            now = g.timeago_now = datetime.utcnow()
         diff = now - datetime_obj
 
         if diff.days > 0:
-            return f'{diff.days} day{"s" if diff.days != 1 else ""} ago'
-        elif diff.seconds > 3600:
-            hours = diff.seconds // 3600
-            return f'{hours} hour{"s" if hours != 1 else ""} ago'
-        elif diff.seconds > 60:
-            minutes = diff.seconds // 60
-            return f'{minutes} minute{"s" if minutes != 1 else ""} ago'
+            count, unit = diff.days, 'day'
         else:
-            return 'Just now'
+            for unit_seconds, unit in TIMEAGO_UNITS:
+                if diff.seconds > unit_seconds:
+                    count = diff.seconds // unit_seconds
+                    break
+            else:
+                return 'Just now'
+        return f'{count} {unit}{"s" if count != 1 else ""} ago'
 
     return app
 
@@ -3,6 +3,10 @@ Domain-specific configurations for adaptive learning system.
 This file contains all the domain-specific guidelines, instructions, and templates
 that are used to customize the AI prompts for different subject areas.
 """
+import textwrap
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Mapping
 
 DOMAIN_CONFIGURATIONS = {
     "economics": {
@@ -266,7 +270,23 @@ DOMAIN_CONFIGURATIONS = {
     }
 }
 
-# Content block templates for different domains
+
+def _freeze_config_value(value):
+    """Lists become tuples; guideline text loses its source indentation, which would otherwise reach every prompt."""
+    if isinstance(value, list):
+        return tuple(value)
+    if isinstance(value, str):
+        return textwrap.dedent(value).strip()
+    return value
+
+
+# Every caller shares these configs, so hand them out read-only
+DOMAIN_CONFIGURATIONS = {
+    domain: MappingProxyType({key: _freeze_config_value(value) for key, value in config.items()})
+    for domain, config in DOMAIN_CONFIGURATIONS.items()
+}
+
+# Content block templates for different domains (dedented below, so prompts carry no indentation)
 CONTENT_BLOCK_TEMPLATES = {
     "concept_explanation": '''
     {
@@ -316,6 +336,8 @@ CONTENT_BLOCK_TEMPLATES = {
       "common_errors": ["mistakes to avoid"]
     }'''
 }
+CONTENT_BLOCK_TEMPLATES = {name: textwrap.dedent(template).strip()
+                           for name, template in CONTENT_BLOCK_TEMPLATES.items()}
 
 # Difficulty level adaptations
 DIFFICULTY_ADAPTATIONS = {
@@ -331,53 +353,101 @@ LEARNING_STYLE_ADAPTATIONS = {
     "mixed": "Balance theoretical understanding with practical applications and examples"
 }
 
+# Course-name keywords for fallback domain detection; earlier domains take priority
+DOMAIN_KEYWORDS = {
+    "economics": ["economics", "econometrics", "macro", "micro", "finance"],
+    "computer_science": ["computer", "programming", "algorithms", "data", "software"],
+    "mathematics": ["mathematics", "calculus", "algebra", "statistics", "math"],
+    "psychology": ["psychology", "behavioral", "cognitive", "social"],
+    "business": ["business", "management", "marketing", "strategy", "mba"],
+    "engineering": ["engineering", "mechanical", "electrical", "civil"],
+    "medicine": ["medicine", "medical", "anatomy", "physiology", "clinical"]
+}
+
+
+# Extra content blocks by domain (applied domains get case studies, quantitative ones problem solving)
+_DOMAIN_BLOCK_TYPES = {
+    "business": ("case_study",),
+    "psychology": ("case_study",),
+    "medicine": ("case_study",),
+    "history": ("case_study",),
+    "law": ("case_study",),
+    "mathematics": ("problem_solving",),
+    "engineering": ("problem_solving",),
+    "economics": ("problem_solving",),
+    "computer_science": ("problem_solving",),
+}
+# Extra content blocks by content type
+_CONTENT_TYPE_BLOCK_TYPES = {
+    "charts": "interactive_visualization",
+    "diagrams": "interactive_visualization",
+    "visualizations": "interactive_visualization",
+    "case studies": "case_study",
+    "calculations": "problem_solving",
+}
+
+
+# Configuration for domains without an entry above; display_name is filled in per domain
+_FALLBACK_DOMAIN_CONFIG = {
+    "learning_characteristics": ("conceptual understanding", "practical application"),
+    "content_types": ("concepts", "examples", "case studies"),
+    "career_applications": ("professional development",),
+    "visualization_types": ("charts", "diagrams"),
+    "assessment_methods": ("multiple_choice", "case_analysis"),
+    "extraction_instructions": "Focus on clear explanations with practical examples",
+    "qa_guidelines": "Provide clear answers with real-world context",
+    "quiz_requirements": "Create questions that test both understanding and application",
+    "simplification_guidelines": "Use simple language with relevant examples",
+    "visualization_guidelines": "Create clear, informative visualizations"
+}
 
-def get_domain_config(domain: str) -> dict:
-    """Get configuration for a specific domain, with fallback to general."""
-    return DOMAIN_CONFIGURATIONS.get(domain, {
-        "display_name": domain.replace('_', ' ').title(),
-        "learning_characteristics": ["conceptual understanding", "practical application"],
-        "content_types": ["concepts", "examples", "case studies"],
-        "career_applications": ["professional development"],
-        "visualization_types": ["charts", "diagrams"],
-        "assessment_methods": ["multiple_choice", "case_analysis"],
-        "extraction_instructions": "Focus on clear explanations with practical examples",
-        "qa_guidelines": "Provide clear answers with real-world context",
-        "quiz_requirements": "Create questions that test both understanding and application",
-        "simplification_guidelines": "Use simple language with relevant examples",
-        "visualization_guidelines": "Create clear, informative visualizations"
-    })
+
+def get_domain_config(domain: str) -> Mapping:
+    """Get the read-only configuration for a specific domain, with fallback to general."""
+    config = DOMAIN_CONFIGURATIONS.get(domain)
+    if config is not None:
+        return config
+    return {"display_name": _fallback_display_name(domain), **_FALLBACK_DOMAIN_CONFIG}
+
+
+@lru_cache(maxsize=256)
+def _fallback_display_name(domain: str) -> str:
+    """Display name for a domain without a configuration, e.g. "art_history" -> "Art History"."""
+    return domain.replace('_', ' ').title()
 
 
 def get_content_block_templates(domain: str, content_types: list) -> str:
     """Generate content block templates based on domain and content types."""
-    templates = []
-
-    # Always include concept explanation
-    templates.append(CONTENT_BLOCK_TEMPLATES["concept_explanation"])
+    # Only membership in content_types matters, so a frozenset makes the memoization key order-free
+    return _build_content_block_templates(domain, frozenset(content_types))
 
-    # Add visualization if appropriate
-    if any(viz_type in content_types for viz_type in ["charts", "diagrams", "visualizations"]):
-        templates.append(CONTENT_BLOCK_TEMPLATES["interactive_visualization"])
 
-    # Add case studies for applied domains
-    if domain in ["business", "psychology", "medicine", "history", "law"] or "case studies" in content_types:
-        templates.append(CONTENT_BLOCK_TEMPLATES["case_study"])
+@lru_cache(maxsize=128)
+def _build_content_block_templates(domain: str, content_types: frozenset) -> str:
+    """Join the content block templates for one domain and set of content types."""
+    # Concept explanations are always included; blocks keep CONTENT_BLOCK_TEMPLATES order
+    block_types = {"concept_explanation", *_DOMAIN_BLOCK_TYPES.get(domain, ())}
+    block_types.update(_CONTENT_TYPE_BLOCK_TYPES[content_type]
+                       for content_type in content_types if content_type in _CONTENT_TYPE_BLOCK_TYPES)
+    return ",\n".join(template for block_type, template in CONTENT_BLOCK_TEMPLATES.items()
+                       if block_type in block_types)
 
-    # Add problem-solving for quantitative domains
-    if domain in ["mathematics", "engineering", "economics", "computer_science"] or "calculations" in content_types:
-        templates.append(CONTENT_BLOCK_TEMPLATES["problem_solving"])
 
-    return ",\n        ".join(templates)
+# Fixed pieces of the existing-books prompt context
+FIRST_BOOK_CONTEXT = "This is the first book in the course."
+EXISTING_BOOKS_CONTEXT_TRAILER = "\nConsider how this new book fits with and complements the existing materials."
 
 
 def format_existing_books_context(existing_books: list) -> str:
     """Format existing books context for prompt inclusion."""
     if not existing_books:
-        return "This is the first book in the course."
+        return FIRST_BOOK_CONTEXT
 
-    context = "EXISTING BOOKS IN THIS COURSE:\n"
+    parts = ["EXISTING BOOKS IN THIS COURSE:\n"]
+    append = parts.append
     for i, book in enumerate(existing_books, 1):
-        context += f"{i}. {book.get('name', 'Unknown')} ({book.get('domain', 'general')}) - {book.get('summary', 'No summary')}\n"
-    context += "\nConsider how this new book fits with and complements the existing materials."
-    return context
\ No newline at end of file
+        get = book.get
+        name, domain, summary = get('name', 'Unknown'), get('domain', 'general'), get('summary', 'No summary')
+        append(f"{i}. {name} ({domain}) - {summary}\n")
+    append(EXISTING_BOOKS_CONTEXT_TRAILER)
+    return "".join(parts)
@@ -1,11 +1,73 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.types import TypeDecorator
+from collections import Counter
 from datetime import datetime
+import copy
 import json
+import threading
+import time
+import zlib
+
+try:
+    import orjson
+
+    def json_dumps(obj) -> str:
+        """Serialize a value for a JSON text column."""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional; fall back to the stdlib codec
+    json_dumps = json.dumps
+    json_loads = json.loads
 
 # Initialize the SQLAlchemy extension.
 db = SQLAlchemy()
 
 
+class CompressedJSON(TypeDecorator):
+    """
+    JSON value stored as a zlib-compressed blob. The column stays declared as TEXT (SQLite
+    stores the bytes as a BLOB), so rows written as plain JSON text before still load.
+    """
+    impl = db.Text
+    cache_ok = True
+
+    COMPRESSION_LEVEL = 6
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return zlib.compress(json_dumps(value).encode('utf-8'), self.COMPRESSION_LEVEL)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                value = zlib.decompress(value)
+            return json_loads(value)
+        except (zlib.error, json.JSONDecodeError):
+            return None  # undecodable content is treated as missing
+
+
+# User-facing names of subject domains; others are derived from the domain key
+DOMAIN_DISPLAY_NAMES = {
+    'computer_science': 'Computer Science',
+    'economics': 'Economics',
+    'mathematics': 'Mathematics',
+    'psychology': 'Psychology',
+    'engineering': 'Engineering',
+    'medicine': 'Medicine',
+    'business': 'Business',
+    'history': 'History',
+    'literature': 'Literature',
+    'physics': 'Physics',
+    'chemistry': 'Chemistry',
+    'biology': 'Biology',
+    'law': 'Law'
+}
+
+
 class Course(db.Model):
     """
     Represents a complete course that can contain multiple subjects/books.
@@ -27,6 +89,9 @@ class Course(db.Model):
     total_chapters = db.Column(db.Integer, default=0)
     estimated_study_hours = db.Column(db.Integer, default=0)
 
+    # AI course context (reused for every PDF uploaded to this course)
+    enhanced_context = db.Column(db.Text, nullable=True)  # JSON: enhance_course_with_web_intelligence output
+
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
@@ -85,7 +150,7 @@ class Subject(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Foreign key
-    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False, index=True)
 
     # Relationships
     chapters = db.relationship('Chapter', backref='subject', lazy=True, cascade="all, delete-orphan")
@@ -109,22 +174,10 @@ class Subject(db.Model):
 
     def get_domain_display_name(self):
         """Get user-friendly display name for subject domain."""
-        domain_names = {
-            'computer_science': 'Computer Science',
-            'economics': 'Economics',
-            'mathematics': 'Mathematics',
-            'psychology': 'Psychology',
-            'engineering': 'Engineering',
-            'medicine': 'Medicine',
-            'business': 'Business',
-            'history': 'History',
-            'literature': 'Literature',
-            'physics': 'Physics',
-            'chemistry': 'Chemistry',
-            'biology': 'Biology',
-            'law': 'Law'
-        }
-        return domain_names.get(self.subject_domain, self.subject_domain.replace('_', ' ').title())
+        display_name = DOMAIN_DISPLAY_NAMES.get(self.subject_domain)
+        if display_name is None:
+            display_name = self.subject_domain.replace('_', ' ').title()
+        return display_name
 
 
 class Chapter(db.Model):
@@ -138,7 +191,7 @@ class Chapter(db.Model):
 
     # Core content fields (JSON)
     intro_summary = db.Column(db.Text, nullable=True)  # JSON: concepts, objectives, context
-    content_blocks = db.Column(db.Text, nullable=True)  # JSON: adaptive content blocks
+    content_blocks = db.Column(CompressedJSON, nullable=True)  # list of adaptive content blocks
     chapter_metadata = db.Column(db.Text, nullable=True)  # JSON: difficulty, study time, skills
 
     # Chapter characteristics
@@ -157,12 +210,13 @@ class Chapter(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Foreign key
-    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False, index=True)
 
     # Relationships
     user_progress = db.relationship('UserProgress', backref='chapter', lazy=True)
     bookmarks = db.relationship('Bookmark', backref='chapter', lazy=True, cascade="all, delete-orphan")
     quiz_results = db.relationship('QuizResult', backref='chapter', lazy=True, cascade="all, delete-orphan")
+    struggle_areas = db.relationship('StruggleArea', backref='chapter', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<Chapter {self.title} ({self.subject.subject_domain})>'
@@ -253,10 +307,14 @@ class UserProgress(db.Model):
     # Adaptive learning data
     difficulty_preference = db.Column(db.String(20), default='intermediate')
     learning_velocity = db.Column(db.Float, default=1.0)  # multiplier for study time estimates
-    struggle_areas = db.Column(db.Text, nullable=True)  # JSON: areas where user needs help
+    struggle_areas = db.Column(db.Text, nullable=True)  # JSON: legacy list; new entries go to StruggleArea
 
     # Unique constraint
-    __table_args__ = (db.UniqueConstraint('user_id', 'subject_id', 'chapter_id', name='unique_progress'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'subject_id', 'chapter_id', name='unique_progress'),
+        # Chapter routes look progress up by (user_id, chapter_id) without subject_id
+        db.Index('ix_user_progress_user_chapter', 'user_id', 'chapter_id'),
+    )
 
     def __repr__(self):
         return f'<UserProgress {self.user_id} - Subject {self.subject_id} - Chapter {self.chapter_id}>'
@@ -289,7 +347,11 @@ class Bookmark(db.Model):
     last_reviewed = db.Column(db.DateTime, nullable=True)
 
     # Unique constraint
-    __table_args__ = (db.UniqueConstraint('user_id', 'chapter_id', 'content_block_index', name='unique_bookmark'),)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'chapter_id', 'content_block_index', name='unique_bookmark'),
+        # view_bookmarks lists a user's bookmarks newest first
+        db.Index('ix_bookmark_user_created', 'user_id', 'created_at'),
+    )
 
     def __repr__(self):
         return f'<Bookmark {self.title}>'
@@ -307,6 +369,28 @@ class Bookmark(db.Model):
         }
 
 
+class StruggleArea(db.Model):
+    """
+    Concept a user scored poorly on in a chapter's quizzes (one row per user, chapter and concept).
+    """
+    __tablename__ = 'struggle_area'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(50), nullable=False)
+    concept = db.Column(db.String(200), nullable=False)
+
+    # Timestamps
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Foreign key
+    chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=False)
+
+    # Unique constraint
+    __table_args__ = (db.UniqueConstraint('user_id', 'chapter_id', 'concept', name='unique_struggle_area'),)
+
+    def __repr__(self):
+        return f'<StruggleArea {self.user_id} - Chapter {self.chapter_id}: {self.concept}>'
+
+
 class QuizResult(db.Model):
     """
     Enhanced quiz results with adaptive difficulty and domain-specific analytics.
@@ -339,6 +423,8 @@ class QuizResult(db.Model):
     # Quiz data for review
     questions_and_answers = db.Column(db.Text, nullable=True)  # JSON: full quiz data
 
+    __table_args__ = (db.Index('ix_quiz_result_user_chapter', 'user_id', 'chapter_id'),)
+
     def __repr__(self):
         return f'<QuizResult {self.user_id} - {self.percentage}% ({self.subject_domain})>'
 
@@ -377,7 +463,8 @@ class StudySession(db.Model):
     chapter_id = db.Column(db.Integer, db.ForeignKey('chapter.id'), nullable=True)
 
     # Session activities
-    activities = db.Column(db.Text, nullable=True)  # JSON: list of activities in session
+    activities = db.Column(db.Text, nullable=True)  # JSON: legacy activity list; new events go to StudyActivity
+    activity_count = db.Column(db.Integer, default=0)  # number of StudyActivity rows logged
     concepts_studied = db.Column(db.Text, nullable=True)  # JSON: concepts covered
     difficulty_adjustments = db.Column(db.Integer, default=0)  # how many times user changed difficulty
 
@@ -392,126 +479,239 @@ class StudySession(db.Model):
     focus_score = db.Column(db.Float, default=0.0)  # calculated focus metric
     learning_effectiveness = db.Column(db.Float, default=0.0)  # calculated learning metric
 
+    # Active-session lookups filter on (user_id, session_end IS NULL); recent lists order by start
+    __table_args__ = (
+        db.Index('ix_study_session_user_end', 'user_id', 'session_end'),
+        db.Index('ix_study_session_user_start', 'user_id', 'session_start'),
+    )
+
     # Relationships
     course = db.relationship('Course', backref='study_sessions', lazy=True)
     subject = db.relationship('Subject', backref='study_sessions', lazy=True)
     chapter = db.relationship('Chapter', backref='study_sessions', lazy=True)
+    activity_log = db.relationship('StudyActivity', backref='study_session', lazy='dynamic',
+                                   cascade="all, delete-orphan")
 
     def __repr__(self):
         return f'<StudySession {self.user_id} - {self.duration_minutes}min>'
 
 
+class StudyActivity(db.Model):
+    """
+    Single activity event within a study session (append-only).
+    """
+    __tablename__ = 'study_activity'
+    id = db.Column(db.Integer, primary_key=True)
+    activity_type = db.Column(db.String(50), nullable=False)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    details = db.Column(db.Text, nullable=True)  # JSON: activity details
+
+    # Foreign key
+    session_id = db.Column(db.Integer, db.ForeignKey('study_session.id'), nullable=False, index=True)
+
+    def to_dict(self):
+        return {
+            'type': self.activity_type,
+            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
+            'details': json_loads(self.details) if self.details else {}
+        }
+
+    def __repr__(self):
+        return f'<StudyActivity {self.activity_type} - Session {self.session_id}>'
+
+
+class UploadJob(db.Model):
+    """
+    Status of a background PDF processing job, kept in the database so any worker can report it.
+    """
+    __tablename__ = 'upload_job'
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    course_id = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    state = db.Column(db.String(20), nullable=False, default='queued')  # queued, processing, completed, failed
+    subject_id = db.Column(db.Integer, nullable=True)
+    subject_domain = db.Column(db.String(50), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<UploadJob {self.id} - {self.state}>'
+
+
 # =========================================================================
 # --- Utility Functions ---
 # =========================================================================
 
+def ensure_schema():
+    """Add declared nullable columns and indexes missing from existing tables (create_all skips those tables)."""
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns and column.nullable:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    connection.execute(db.text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'
+                    ))
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
 def update_course_stats(course_id: int):
-    """Update course statistics based on contained subjects."""
+    """Update course statistics based on contained subjects, committing them with any pending changes."""
     course = Course.query.get(course_id)
     if course:
-        subjects = Subject.query.filter_by(course_id=course_id).all()
-        course.total_subjects = len(subjects)
-        course.total_chapters = sum(subject.total_chapters for subject in subjects)
-        course.estimated_study_hours = sum(subject.estimated_read_time for subject in subjects) // 60
-        db.session.commit()
+        # Summed in SQL rather than loading every subject
+        total_subjects, total_chapters, read_minutes = db.session.query(
+            db.func.count(Subject.id),
+            db.func.coalesce(db.func.sum(Subject.total_chapters), 0),
+            db.func.coalesce(db.func.sum(Subject.estimated_read_time), 0)
+        ).filter(Subject.course_id == course_id).one()
+        course.total_subjects = total_subjects
+        course.total_chapters = total_chapters
+        course.estimated_study_hours = read_minutes // 60
+    db.session.commit()
 
 
 def update_subject_stats(subject_id: int):
-    """Update subject statistics based on contained chapters."""
+    """Update subject and course statistics, committing them with any pending changes in one transaction."""
     subject = Subject.query.get(subject_id)
     if subject:
-        chapters = Chapter.query.filter_by(subject_id=subject_id).all()
-        subject.total_chapters = len(chapters)
-        subject.estimated_read_time = sum(chapter.estimated_study_time or 30 for chapter in chapters)
-        subject.interactive_elements_count = sum(
-            (chapter.visualization_count or 0) + (chapter.exercise_count or 0)
-            for chapter in chapters
-        )
-        db.session.commit()
-
-        # Update parent course stats
+        # Summed in SQL rather than loading every chapter (and its content blocks);
+        # a missing or zero study time counts as 30 minutes
+        total_chapters, read_time, interactive_elements = db.session.query(
+            db.func.count(Chapter.id),
+            db.func.coalesce(db.func.sum(db.func.coalesce(db.func.nullif(Chapter.estimated_study_time, 0), 30)), 0),
+            db.func.coalesce(db.func.sum(
+                db.func.coalesce(Chapter.visualization_count, 0) + db.func.coalesce(Chapter.exercise_count, 0)
+            ), 0)
+        ).filter(Chapter.subject_id == subject_id).one()
+        subject.total_chapters = total_chapters
+        subject.estimated_read_time = read_time
+        subject.interactive_elements_count = interactive_elements
+
+        # Update parent course stats; its commit covers the subject too
         if subject.course_id:
             update_course_stats(subject.course_id)
+            return
+    db.session.commit()
+
+
+def content_block_counts(content_blocks: list) -> dict:
+    """Chapter counter columns for a list of content blocks, counted in one pass."""
+    type_counts = Counter(b.get('type') for b in content_blocks)
+    return {
+        'total_content_blocks': len(content_blocks),
+        'concept_count': type_counts['concept_explanation'],
+        'visualization_count': type_counts['interactive_visualization'],
+        'exercise_count': type_counts['problem_solving'],
+        'case_study_count': type_counts['case_study'],
+    }
+
+
+def _apply_content_block_counts(chapter):
+    """Set a chapter's content block counters from its content_blocks."""
+    for column, count in content_block_counts(chapter.content_blocks).items():
+        setattr(chapter, column, count)
 
 
 def update_chapter_stats(chapter_id: int):
     """Update chapter statistics based on content blocks."""
     chapter = Chapter.query.get(chapter_id)
     if chapter and chapter.content_blocks:
-        try:
-            content_blocks = json.loads(chapter.content_blocks)
-            chapter.total_content_blocks = len(content_blocks)
-
-            # Count different types of content blocks
-            chapter.concept_count = len([b for b in content_blocks if b.get('type') == 'concept_explanation'])
-            chapter.visualization_count = len(
-                [b for b in content_blocks if b.get('type') == 'interactive_visualization'])
-            chapter.exercise_count = len([b for b in content_blocks if b.get('type') == 'problem_solving'])
-            chapter.case_study_count = len([b for b in content_blocks if b.get('type') == 'case_study'])
+        _apply_content_block_counts(chapter)
 
+        # Update parent subject stats, committing the chapter counters with them
+        if chapter.subject_id:
+            update_subject_stats(chapter.subject_id)
+        else:
             db.session.commit()
 
-            # Update parent subject stats
-            if chapter.subject_id:
-                update_subject_stats(chapter.subject_id)
-
-        except json.JSONDecodeError:
-            pass
-
 
 def get_user_course_progress(user_id: str, course_id: int) -> dict:
     """Get comprehensive progress summary for a user in a specific course."""
-    enrollment = CourseEnrollment.query.filter_by(user_id=user_id, course_id=course_id).first()
+    enrollment = db.session.query(
+        CourseEnrollment.course_id,
+        CourseEnrollment.enrollment_date,
+        CourseEnrollment.overall_progress_percentage,
+        CourseEnrollment.last_activity
+    ).filter_by(user_id=user_id, course_id=course_id).first()
     if not enrollment:
         return {"error": "User not enrolled in course"}
 
-    progress_entries = UserProgress.query.join(Subject).filter(
-        UserProgress.user_id == user_id,
-        Subject.course_id == course_id
-    ).all()
-
-    total_subjects = Subject.query.filter_by(course_id=course_id).count()
-    completed_subjects = len(set(
-        entry.subject_id for entry in progress_entries
-        if entry.status == 'completed' and entry.chapter_id is None
-    ))
+    return get_user_course_progress_batch(user_id, [enrollment])[course_id]
+
+
+def get_user_course_progress_batch(user_id: str, enrollments: list) -> dict:
+    """Progress summaries for several of a user's enrollments at once, keyed by course_id."""
+    course_ids = [enrollment.course_id for enrollment in enrollments]
+    if not course_ids:
+        return {}
+
+    # Progress aggregates per course, reduced in SQL instead of hydrating every UserProgress row
+    completed = UserProgress.status == 'completed'
+    progress_by_course = {
+        course_id: (completed_subjects, completed_chapters, total_time)
+        for course_id, completed_subjects, completed_chapters, total_time in db.session.query(
+            Subject.course_id,
+            db.func.count(db.distinct(db.case(
+                (db.and_(completed, UserProgress.chapter_id.is_(None)), UserProgress.subject_id)
+            ))),
+            db.func.count(db.case((db.and_(completed, UserProgress.chapter_id.isnot(None)), 1))),
+            db.func.coalesce(db.func.sum(UserProgress.time_spent_minutes), 0)
+        ).select_from(UserProgress).join(Subject).filter(
+            UserProgress.user_id == user_id,
+            Subject.course_id.in_(course_ids)
+        ).group_by(Subject.course_id).all()
+    }
 
-    total_chapters = db.session.query(Chapter).join(Subject).filter(
-        Subject.course_id == course_id
-    ).count()
-    completed_chapters = len([
-        entry for entry in progress_entries
-        if entry.status == 'completed' and entry.chapter_id is not None
-    ])
+    # Subject and chapter totals per course from one outer join
+    totals_by_course = {
+        course_id: (subject_count, chapter_count)
+        for course_id, subject_count, chapter_count in db.session.query(
+            Subject.course_id, db.func.count(db.distinct(Subject.id)), db.func.count(Chapter.id)
+        ).outerjoin(Chapter, Chapter.subject_id == Subject.id).filter(
+            Subject.course_id.in_(course_ids)
+        ).group_by(Subject.course_id).all()
+    }
 
-    total_time = sum(entry.time_spent_minutes for entry in progress_entries)
-    quiz_results = QuizResult.query.join(Chapter).join(Subject).filter(
-        QuizResult.user_id == user_id,
-        Subject.course_id == course_id
-    ).all()
+    quizzes_by_course = {
+        course_id: (count, average)
+        for course_id, count, average in db.session.query(
+            Subject.course_id, db.func.count(QuizResult.id), db.func.avg(QuizResult.percentage)
+        ).select_from(QuizResult).join(Chapter).join(Subject).filter(
+            QuizResult.user_id == user_id,
+            Subject.course_id.in_(course_ids)
+        ).group_by(Subject.course_id).all()
+    }
 
-    avg_quiz_score = (
-        sum(qr.percentage for qr in quiz_results) / len(quiz_results)
-        if quiz_results else 0
-    )
+    summaries = {}
+    for enrollment in enrollments:
+        course_id = enrollment.course_id
+        completed_subjects, completed_chapters, total_time = progress_by_course.get(course_id, (0, 0, 0))
+        subject_count, chapter_count = totals_by_course.get(course_id, (0, 0))
+        quizzes_taken, avg_quiz_score = quizzes_by_course.get(course_id, (0, None))
+
+        summaries[course_id] = {
+            'course_id': course_id,
+            'enrollment_date': enrollment.enrollment_date.isoformat(),
+            'overall_progress': enrollment.overall_progress_percentage,
+            'subjects_completed': f"{completed_subjects}/{subject_count}",
+            'chapters_completed': f"{completed_chapters}/{chapter_count}",
+            'total_study_time_hours': round(total_time / 60, 1),
+            'average_quiz_score': round(avg_quiz_score or 0, 1),
+            'quizzes_taken': quizzes_taken,
+            'last_activity': enrollment.last_activity.isoformat() if enrollment.last_activity else None
+        }
 
-    return {
-        'course_id': course_id,
-        'enrollment_date': enrollment.enrollment_date.isoformat(),
-        'overall_progress': enrollment.overall_progress_percentage,
-        'subjects_completed': f"{completed_subjects}/{total_subjects}",
-        'chapters_completed': f"{completed_chapters}/{total_chapters}",
-        'total_study_time_hours': round(total_time / 60, 1),
-        'average_quiz_score': round(avg_quiz_score, 1),
-        'quizzes_taken': len(quiz_results),
-        'last_activity': enrollment.last_activity.isoformat() if enrollment.last_activity else None
-    }
+    return summaries
 
 
 def get_adaptive_recommendations(user_id: str, course_id: int) -> dict:
     """Generate adaptive learning recommendations based on user progress."""
-    progress_data = get_user_course_progress(user_id, course_id)
-
     # Analyze user's learning patterns
     progress_entries = UserProgress.query.join(Subject).filter(
         UserProgress.user_id == user_id,
@@ -523,14 +723,17 @@ def get_adaptive_recommendations(user_id: str, course_id: int) -> dict:
     completed_chapters = len([e for e in progress_entries if e.status == 'completed'])
     avg_time_per_chapter = total_time / completed_chapters if completed_chapters > 0 else 30
 
-    # Identify struggle areas
-    low_quiz_scores = QuizResult.query.join(Chapter).join(Subject).filter(
-        QuizResult.user_id == user_id,
-        Subject.course_id == course_id,
-        QuizResult.percentage < 70
-    ).all()
-
-    struggle_domains = list(set(qr.subject_domain for qr in low_quiz_scores if qr.subject_domain))
+    # Identify struggle areas: domains of low quiz scores, using the domain stored on each result
+    course_chapter_ids = db.select(Chapter.id).join(Subject).where(Subject.course_id == course_id)
+    struggle_domains = list(db.session.scalars(
+        db.select(QuizResult.subject_domain).distinct().where(
+            QuizResult.user_id == user_id,
+            QuizResult.chapter_id.in_(course_chapter_ids),
+            QuizResult.percentage < 70,
+            QuizResult.subject_domain.isnot(None),
+            QuizResult.subject_domain != ''
+        )
+    ))
 
     # Generate recommendations
     recommendations = {
@@ -555,23 +758,59 @@ def get_adaptive_recommendations(user_id: str, course_id: int) -> dict:
     return recommendations
 
 
+# Recommendations are recomputed from several progress/quiz queries, so keep
+# them briefly per (user_id, course_id); routes that change progress invalidate.
+RECOMMENDATIONS_CACHE_TTL = 120  # seconds
+_RECOMMENDATIONS_CACHE = {}
+_RECOMMENDATIONS_CACHE_LOCK = threading.Lock()
+
+
+def get_cached_adaptive_recommendations(user_id: str, course_id: int) -> dict:
+    """Return get_adaptive_recommendations() for the pair, cached for a short TTL."""
+    key = (user_id, course_id)
+    now = time.monotonic()
+    with _RECOMMENDATIONS_CACHE_LOCK:
+        entry = _RECOMMENDATIONS_CACHE.get(key)
+        if entry and entry[0] > now:
+            return copy.deepcopy(entry[1])
+
+    recommendations = get_adaptive_recommendations(user_id, course_id)
+    with _RECOMMENDATIONS_CACHE_LOCK:
+        # Drop expired entries so the dict stays bounded by active users
+        for stale_key in [k for k, (expires, _) in _RECOMMENDATIONS_CACHE.items() if expires <= now]:
+            del _RECOMMENDATIONS_CACHE[stale_key]
+        _RECOMMENDATIONS_CACHE[key] = (now + RECOMMENDATIONS_CACHE_TTL, recommendations)
+    return copy.deepcopy(recommendations)
+
+
+def invalidate_adaptive_recommendations(user_id: str, course_id: int = None):
+    """Forget cached recommendations for a user (one course, or all of them)."""
+    with _RECOMMENDATIONS_CACHE_LOCK:
+        if course_id is not None:
+            _RECOMMENDATIONS_CACHE.pop((user_id, course_id), None)
+            return
+        for key in [k for k in _RECOMMENDATIONS_CACHE if k[0] == user_id]:
+            del _RECOMMENDATIONS_CACHE[key]
+
+
 def _get_next_recommended_chapters(user_id: str, course_id: int) -> list:
     """Get recommended next chapters for study."""
-    completed_chapter_ids = [
-        entry.chapter_id for entry in UserProgress.query.join(Subject).filter(
-            UserProgress.user_id == user_id,
-            Subject.course_id == course_id,
-            UserProgress.status == 'completed',
-            UserProgress.chapter_id.isnot(None)
-        ).all()
-    ]
+    completed_chapter_ids = db.select(UserProgress.chapter_id).where(
+        UserProgress.user_id == user_id,
+        UserProgress.status == 'completed',
+        UserProgress.chapter_id.isnot(None)
+    )
 
-    next_chapters = Chapter.query.join(Subject).filter(
+    # Only the three columns returned, with the subject name from the same JOIN
+    next_chapters = db.session.query(Chapter.id, Chapter.title, Subject.name).join(Subject).filter(
         Subject.course_id == course_id,
         ~Chapter.id.in_(completed_chapter_ids)
     ).order_by(Subject.created_at, Chapter.chapter_number).limit(3).all()
 
-    return [{'id': ch.id, 'title': ch.title, 'subject': ch.subject.name} for ch in next_chapters]
+    return [
+        {'id': chapter_id, 'title': title, 'subject': subject_name}
+        for chapter_id, title, subject_name in next_chapters
+    ]
 
 
 def _recommend_difficulty_level(progress_entries: list) -> str:
@@ -583,10 +822,12 @@ def _recommend_difficulty_level(progress_entries: list) -> str:
     if not chapter_progress_entries:
         return 'intermediate'
 
+    # Expected study times for all chapters in one IN query
+    study_times = dict(db.session.query(Chapter.id, Chapter.estimated_study_time).filter(
+        Chapter.id.in_({entry.chapter_id for entry in chapter_progress_entries})
+    ).all())
     avg_time_ratio = sum(
-        entry.time_spent_minutes / (
-            int(Chapter.query.get(entry.chapter_id).estimated_study_time or 30)
-        )
+        entry.time_spent_minutes / int(study_times.get(entry.chapter_id) or 30)
         for entry in chapter_progress_entries
     ) / len(chapter_progress_entries)
 
@@ -598,39 +839,41 @@ def _recommend_difficulty_level(progress_entries: list) -> str:
         return 'intermediate'
 
 
+# Study strategies for domains a user is struggling in, and the general advice used otherwise
+DOMAIN_STUDY_STRATEGIES = {
+    'economics': (
+        'Focus on real-world examples and current events',
+        'Practice with economic calculators and models',
+        'Review graphical representations of economic concepts'
+    ),
+    'computer_science': (
+        'Code along with examples in your preferred language',
+        'Build small projects to apply concepts',
+        'Use visualization tools for algorithms and data structures'
+    ),
+    'mathematics': (
+        'Work through problems step-by-step',
+        'Use visual aids and geometric interpretations',
+        'Practice regularly with spaced repetition'
+    ),
+    'business': (
+        'Analyze real company case studies',
+        'Connect theories to current business news',
+        'Practice with business simulation tools'
+    )
+}
+GENERAL_STUDY_STRATEGIES = (
+    'Review difficult concepts multiple times',
+    'Take breaks between study sessions',
+    'Ask questions when concepts are unclear',
+    'Use active recall techniques'
+)
+
+
 def _get_domain_specific_strategies(struggle_domains: list) -> list:
     """Get learning strategies specific to domains where user is struggling."""
-    strategies = {
-        'economics': [
-            'Focus on real-world examples and current events',
-            'Practice with economic calculators and models',
-            'Review graphical representations of economic concepts'
-        ],
-        'computer_science': [
-            'Code along with examples in your preferred language',
-            'Build small projects to apply concepts',
-            'Use visualization tools for algorithms and data structures'
-        ],
-        'mathematics': [
-            'Work through problems step-by-step',
-            'Use visual aids and geometric interpretations',
-            'Practice regularly with spaced repetition'
-        ],
-        'business': [
-            'Analyze real company case studies',
-            'Connect theories to current business news',
-            'Practice with business simulation tools'
-        ]
-    }
-
     recommended = []
     for domain in struggle_domains[:3]:  # Top 3 struggle areas
-        if domain in strategies:
-            recommended.extend(strategies[domain])
-
-    return recommended or [
-        'Review difficult concepts multiple times',
-        'Take breaks between study sessions',
-        'Ask questions when concepts are unclear',
-        'Use active recall techniques'
-    ]
\ No newline at end of file
+        recommended.extend(DOMAIN_STUDY_STRATEGIES.get(domain, ()))
+
+    return recommended or list(GENERAL_STUDY_STRATEGIES)
\ No newline at end of file